@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+Stress tests git work from many worker threads at once. Tasks run on a
+thread.WorkerPool against local repos and either check a patchset out in
+a project's upstream workspace, borrowing objects from the project's
+mirror, or look a patchset up in the mirror. Every task checks that it
+saw the right commit and that the process working directory never
+changed. Reports tasks per second and any failures.
+
+Usage:
+    python benchmarks/concurrent_git.py [--tasks 400] [--threads 8]
+
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from gerrit_python_tools import git  # noqa: E402
+from gerrit_python_tools import mirror  # noqa: E402
+from gerrit_python_tools import thread  # noqa: E402
+from gerrit_python_tools import workspace  # noqa: E402
+
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'Benchmark',
+    'GIT_AUTHOR_EMAIL': 'benchmark@example.com',
+    'GIT_COMMITTER_NAME': 'Benchmark',
+    'GIT_COMMITTER_EMAIL': 'benchmark@example.com'
+}
+
+
+def get_args():
+    """
+    Set up and use the argument parser.
+
+    @return argparse.Namespace
+
+    """
+    parser = argparse.ArgumentParser(description="Stress tests concurrent"
+                                     " git work.")
+    parser.add_argument('--tasks', type=int, default=400,
+                        help="Tasks to run (default: 400)")
+    parser.add_argument('--threads', type=int, default=8,
+                        help="Worker threads (default: 8)")
+    parser.add_argument('--projects', type=int, default=8,
+                        help="Projects, each with a repo (default: 8)")
+    parser.add_argument('--patchsets', type=int, default=10,
+                        help="Patchsets per project (default: 10)")
+    return parser.parse_args()
+
+
+def make_repo(path, name, patchsets):
+    """
+    Creates a bare repo with a master branch and a change whose patchsets
+    each set a file to a different content.
+
+    @param path - String path of the repo
+    @param name - String project name
+    @param patchsets - Integer number of patchsets
+    @return Dictionary of patchset ref to (revision, file contents)
+
+    """
+    subprocess.check_call(['git', 'init', '-q', '--bare', path])
+    stream = ['commit refs/heads/master\n', 'mark :1\n',
+              'committer Benchmark <benchmark@example.com> 1400000000 +0000\n',
+              'data 4\nbase\n',
+              'M 644 inline README\ndata 5\nbase\n\n']
+    contents = {}
+    for number in range(1, patchsets + 1):
+        ref = 'refs/changes/01/1/%s' % number
+        contents[ref] = '%s patchset %s\n' % (name, number)
+        stream += ['commit %s\n' % ref,
+                   'committer Benchmark <benchmark@example.com> %d +0000\n'
+                   % (1400000000 + number),
+                   'data 8\npatchset\n',
+                   'from :1\n',
+                   'M 644 inline change.txt\ndata %d\n%s\n'
+                   % (len(contents[ref]), contents[ref])]
+    proc = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path,
+                            stdin=subprocess.PIPE)
+    proc.communicate(''.join(stream))
+    if proc.returncode:
+        raise Exception("git fast-import failed")
+    return dict((ref, (git.rev_parse(ref, cwd=path), text))
+                for ref, text in contents.items())
+
+
+if __name__ == '__main__':
+    args = get_args()
+    os.environ.update(GIT_ENV)
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp(prefix='concurrent-git-')
+    try:
+        mirrors = mirror.MirrorCache(os.path.join(tmp, 'mirrors'),
+                                     10 * 1024 ** 3, 10 ** 9)
+        workspaces = workspace.WorkspacePool(os.path.join(tmp, 'workspaces'),
+                                             10 * 1024 ** 3)
+        projects = {}
+        for i in range(args.projects):
+            name = 'project-%s' % i
+            path = os.path.join(tmp, 'repos', '%s.git' % name)
+            projects[name] = ('file://%s' % path,
+                              make_repo(path, name, args.patchsets))
+
+        failures = []
+        finished = []
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def check(ok, msg):
+            if not ok:
+                with lock:
+                    failures.append(msg)
+
+        def send_task(name, ref):
+            url, refs = projects[name]
+            mirror_path = mirrors.path_for(url)
+            with workspaces.lease(name, {'downstream': url},
+                                  mirror_path=mirror_path) as path:
+                workspaces.checkout(path, 'downstream', ref)
+                text = git.git_output(['git', 'show', 'HEAD:change.txt'],
+                                      cwd=path)
+                check(text == refs[ref][1],
+                      "%s %s: workspace has %r" % (name, ref, text))
+
+        def mirror_task(name, ref):
+            url, refs = projects[name]
+            with mirrors.lease(url) as path:
+                git.fetch('origin', refspecs=['+%s:%s' % (ref, ref)],
+                          cwd=path)
+                revision = git.rev_parse(ref, cwd=path)
+                check(revision == refs[ref][0],
+                      "%s %s: mirror has %s" % (name, ref, revision))
+
+        def task(func, name, ref):
+            try:
+                func(name, ref)
+            except Exception as e:
+                check(False, "%s %s: %s" % (name, ref, e))
+            check(os.getcwd() == cwd, "working directory changed")
+            with lock:
+                finished.append(1)
+                if len(finished) == args.tasks:
+                    done.set()
+
+        rnd = random.Random(0)
+        tasks = []
+        for _ in range(args.tasks):
+            name = rnd.choice(sorted(projects))
+            ref = rnd.choice(sorted(projects[name][1]))
+            tasks.append((rnd.choice([send_task, mirror_task]), name, ref))
+
+        pool = thread.WorkerPool(args.threads)
+        start = time.time()
+        for func, name, ref in tasks:
+            pool.add_task(task, func, name, ref)
+        done.wait()
+        elapsed = time.time() - start
+        # stop_threads exits with success, stop the workers directly
+        for t in threading.enumerate():
+            if isinstance(t, thread.StoppableThread):
+                t.stop()
+
+        print "%s tasks on %s threads in %.2fs: %.1f tasks/s" % (
+            args.tasks, args.threads, elapsed, args.tasks / elapsed)
+        print "Failures: %s" % len(failures)
+        for msg in failures[:20]:
+            print "  %s" % msg
+    finally:
+        shutil.rmtree(tmp)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Benchmarks the time from an event being put into the dispatcher until a
+worker starts on the task it causes. The consumer loop blocks on the
+dispatcher and hands each event to the worker pool the way
+service.service does. Also reports the CPU used while no events arrive.
+
+Usage:
+    python benchmarks/dispatch_latency.py [--events 2000] [--threads 4]
+
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from gerrit_python_tools import thread  # noqa: E402
+
+
+def get_args():
+    """
+    Set up and use the argument parser.
+
+    @return argparse.Namespace
+
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks event to task"
+                                     " latency.")
+    parser.add_argument('--events', type=int, default=2000,
+                        help="Events to dispatch (default: 2000)")
+    parser.add_argument('--interval', type=float, default=0.001,
+                        help="Seconds between events (default: 0.001)")
+    parser.add_argument('--threads', type=int, default=4,
+                        help="Worker threads (default: 4)")
+    parser.add_argument('--sleep', type=float, default=5,
+                        help="Longest dispatcher wait, like daemon.sleep"
+                        " (default: 5)")
+    parser.add_argument('--idle', type=float, default=3,
+                        help="Seconds to measure idle CPU (default: 3)")
+    return parser.parse_args()
+
+
+def cpu_time():
+    """
+    Returns the user and system CPU time used by the process.
+
+    @return Float seconds
+
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def percentile(values, pct):
+    """
+    Returns a percentile of sorted values.
+
+    @param values - Sorted List of Numbers
+    @param pct - Number percentile between 0 and 100
+    @return Number
+
+    """
+    index = min(len(values) - 1, int(len(values) * pct / 100.0))
+    return values[index]
+
+
+if __name__ == '__main__':
+    args = get_args()
+    dispatcher = thread.Dispatcher()
+    pool = thread.WorkerPool(args.threads)
+    latencies = []
+    lock = threading.Lock()
+    done = threading.Event()
+    stop = threading.Event()
+
+    def task(sent):
+        latency = time.time() - sent
+        with lock:
+            latencies.append(latency)
+            if len(latencies) == args.events:
+                done.set()
+
+    def consume():
+        while not stop.is_set():
+            item = dispatcher.wait(args.sleep)
+            if item is None:
+                continue
+            source, sent, seq = item
+            if sent is not None:
+                pool.add_task(task, sent)
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+
+    start_cpu = cpu_time()
+    time.sleep(args.idle)
+    idle_cpu = 100.0 * (cpu_time() - start_cpu) / args.idle
+
+    for _ in range(args.events):
+        dispatcher.put('downstream', time.time())
+        time.sleep(args.interval)
+    done.wait()
+    stop.set()
+    dispatcher.put('downstream', None)
+    consumer.join()
+
+    latencies = sorted(latencies)
+    print "Idle CPU: %.2f%% over %ss" % (idle_cpu, args.idle)
+    print "Latency over %s events:" % len(latencies)
+    for pct in (50, 90, 99):
+        print "  p%s: %.3f ms" % (pct, percentile(latencies, pct) * 1000)
+    print "  max: %.3f ms" % (latencies[-1] * 1000)
+    thread.stop_threads(None, None)
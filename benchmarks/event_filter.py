@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+Benchmarks the raw event pre-filter of the downstream stream over an event
+corpus. The corpus is a file with one event per line, as recorded with
+
+    ssh -p 29418 user@gerrit gerrit stream-events > corpus
+
+A synthetic corpus is generated if no file is given. Events per second are
+reported for decoding every event, with and without formatting it for
+debug logging as the stream once did, and for the pre-filter followed by
+decoding only the events it keeps.
+
+Usage:
+    python benchmarks/event_filter.py [--corpus FILE] [--projects 1000]
+
+"""
+import argparse
+import json
+import os
+import pprint
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from gerrit_python_tools import config  # noqa: E402
+from gerrit_python_tools import service  # noqa: E402
+
+TRIGGER = 'upstream'
+
+
+def get_args():
+    """
+    Set up and use the argument parser.
+
+    @return argparse.Namespace
+
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks the raw event"
+                                     " pre-filter.")
+    parser.add_argument('--corpus', type=str, default=None,
+                        help="File of recorded events, one per line")
+    parser.add_argument('--events', type=int, default=100000,
+                        help="Events in a synthetic corpus (default: 100000)")
+    parser.add_argument('--projects', type=int, default=1000,
+                        help="Configured projects (default: 1000)")
+    parser.add_argument('--upstream', type=float, default=0.1,
+                        help="Share of projects sent upstream (default: 0.1)")
+    return parser.parse_args()
+
+
+def make_config(names, upstream):
+    """
+    Returns a configuration with the daemon sending changes upstream.
+
+    @param names - List of String project names
+    @param upstream - Set of String names of projects sent upstream
+    @return config.Config
+
+    """
+    return config.Config({
+        'daemon': {'upstream': True, 'sync': True},
+        'upstream': {'trigger': TRIGGER},
+        'projects': [{'name': n, 'upstream': n in upstream} for n in names]
+    })
+
+
+def synthetic_corpus(count, names):
+    """
+    Generates events like a busy gerrit streams them. Most are comments
+    and patchsets on any project and a few mention the trigger.
+
+    @param count - Integer number of events
+    @param names - List of String project names
+    @return List of String raw events
+
+    """
+    rnd = random.Random(0)
+    lines = []
+    for i in range(count):
+        project = rnd.choice(names)
+        change = {'project': project, 'branch': 'master',
+                  'id': 'I%040x' % i, 'number': str(i),
+                  'subject': 'Change %s' % i,
+                  'owner': {'name': 'Dev', 'username': 'dev'}}
+        patch_set = {'number': '1', 'revision': '%040x' % i,
+                     'ref': 'refs/changes/%02d/%s/1' % (i % 100, i)}
+        kind = rnd.random()
+        if kind < 0.6:
+            comment = 'Patch Set 1: Code-Review+1\n\nLooks good.'
+            if rnd.random() < 0.05:
+                comment = 'Patch Set 1:\n\n%s' % TRIGGER
+            event = {'type': 'comment-added', 'change': change,
+                     'patchSet': patch_set, 'comment': comment,
+                     'author': {'name': 'Reviewer', 'username': 'rev'},
+                     'approvals': [{'type': 'Code-Review', 'value': '1'}]}
+        elif kind < 0.9:
+            event = {'type': 'patchset-created', 'change': change,
+                     'patchSet': patch_set,
+                     'uploader': {'name': 'Dev', 'username': 'dev'}}
+        else:
+            event = {'type': 'ref-updated',
+                     'refUpdate': {'project': project,
+                                   'refName': 'refs/heads/master',
+                                   'oldRev': '0' * 40, 'newRev': '%040x' % i},
+                     'submitter': {'name': 'Dev', 'username': 'dev'}}
+        event['eventCreatedOn'] = 1400000000 + i
+        lines.append(json.dumps(event))
+    return lines
+
+
+def wanted(event, conf):
+    """
+    Decides on a decoded event the way the filter does on a raw one.
+
+    @param event - Dictionary event
+    @param conf - config.Config
+    @return Boolean
+
+    """
+    return (event.get('type') == 'comment-added' and
+            event.get('change', {}).get('project') in conf.upstream_projects
+            and TRIGGER in event.get('comment', ''))
+
+
+def run(name, lines, classify):
+    """
+    Times classify over every line and prints events per second.
+
+    @param name - String name of the measurement
+    @param lines - List of String raw events
+    @param classify - Function taking a raw event and returning whether
+        it is kept
+    @return Integer number of events kept
+
+    """
+    start = time.time()
+    kept = sum(1 for line in lines if classify(line))
+    elapsed = time.time() - start
+    print "%-28s %10.0f events/s  kept %s" % (name, len(lines) / elapsed,
+                                              kept)
+    return kept
+
+
+if __name__ == '__main__':
+    args = get_args()
+    names = ['project-%s' % i for i in range(args.projects)]
+    upstream = set(names[:int(args.projects * args.upstream)])
+    conf = make_config(names, upstream)
+
+    if args.corpus:
+        with open(args.corpus, 'r') as f:
+            lines = [line.strip() for line in f if line.strip()]
+    else:
+        lines = synthetic_corpus(args.events, names)
+    print "%s events, %s projects, %s upstream" % (len(lines), len(names),
+                                                   len(upstream))
+
+    event_filter = service.downstream_event_filter(conf)
+
+    def decode_format(line):
+        event = json.loads(line)
+        pprint.pformat(event)
+        return wanted(event, conf)
+
+    def decode(line):
+        return wanted(json.loads(line), conf)
+
+    def prefilter(line):
+        return event_filter(line) and wanted(json.loads(line), conf)
+
+    run("decode + debug format", lines, decode_format)
+    run("decode", lines, decode)
+    run("pre-filter + decode kept", lines, prefilter)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+Benchmarks the checks made on a comment-added event before a change is
+sent upstream: whether its project is an upstream project and whether its
+approvals pass the project's label gate. The checks run against a large
+configuration and are compared with walking the projects list and
+building labels from dictionaries for every event.
+
+Usage:
+    python benchmarks/label_gate.py [--projects 10000] [--checks 100000]
+
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from gerrit_python_tools import config  # noqa: E402
+from gerrit_python_tools import gerrit  # noqa: E402
+from gerrit_python_tools import log  # noqa: E402
+
+LABELS = [{'name': 'Code-Review', 'min': -2, 'max': 2},
+          {'name': 'Verified', 'min': -1, 'max': 1}]
+PROJECT_LABELS = [{'name': 'Code-Review', 'min': -2, 'max': 2},
+                  {'name': 'Verified', 'min': -1, 'max': 1},
+                  {'name': 'Workflow', 'min': -1, 'max': 1}]
+
+
+def get_args():
+    """
+    Set up and use the argument parser.
+
+    @return argparse.Namespace
+
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks upstream gate"
+                                     " checks.")
+    parser.add_argument('--projects', type=int, default=10000,
+                        help="Configured projects (default: 10000)")
+    parser.add_argument('--checks', type=int, default=100000,
+                        help="Events to check (default: 100000)")
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        help="Level to log at while checking. Debug"
+                        " logging writes several lines per check"
+                        " (default: INFO)")
+    return parser.parse_args()
+
+
+def make_data(count):
+    """
+    Returns configuration data with count projects. Half are upstream and
+    every tenth has labels of its own.
+
+    @param count - Integer number of projects
+    @return Dictionary
+
+    """
+    projects = []
+    for i in range(count):
+        project = {'name': 'project-%s' % i, 'upstream': i % 2 == 0}
+        if i % 10 == 0:
+            project['upstream-labels'] = PROJECT_LABELS
+        projects.append(project)
+    return {'projects': projects, 'upstream-labels': LABELS}
+
+
+def make_events(count, projects, conf):
+    """
+    Returns comment-added events on random projects with approvals.
+
+    @param count - Integer number of events
+    @param projects - Integer number of configured projects
+    @param conf - config.Config
+    @return List of (gerrit.CommentAdded, List of gerrit.Approval) tuples
+
+    """
+    rnd = random.Random(0)
+    events = []
+    for i in range(count):
+        data = {'type': 'comment-added',
+                'change': {'project': 'project-%s' % rnd.randrange(projects),
+                           'id': 'I%040x' % i, 'number': str(i)},
+                'patchSet': {'number': '1'},
+                'comment': 'upstream'}
+        approvals = [gerrit.Approval({'type': 'Code-Review', 'value': '2'}),
+                     gerrit.Approval({'type': 'Verified', 'value': '1'})]
+        events.append((gerrit.CommentAdded(data, conf), approvals))
+    return events
+
+
+def list_walk(data, project_name, approvals):
+    """
+    Checks an event by walking the projects list and building labels from
+    dictionaries, as was done for every event before the index.
+
+    @param data - Dictionary configuration data
+    @param project_name - String project name
+    @param approvals - List of gerrit.Approval
+    @return Boolean
+
+    """
+    project = None
+    for p in data['projects']:
+        if p['name'] == project_name:
+            project = p
+            break
+    if project is None or not project.get('upstream', False):
+        return False
+    for p in data['projects']:
+        if p['name'] == project_name:
+            label_dicts = p.get('upstream-labels', data['upstream-labels'])
+            break
+    labels = dict((d['name'], gerrit.Label(d['name'], int(d['min']),
+                                           int(d['max'])))
+                  for d in label_dicts)
+    for approval in approvals:
+        if approval.name in labels:
+            labels[approval.name].add_approval(approval)
+    return all(label.approved() for label in labels.values())
+
+
+def run(name, events, check):
+    """
+    Times check over every event and prints checks per second.
+
+    @param name - String name of the measurement
+    @param events - List of (CommentAdded, approvals) tuples
+    @param check - Function taking a CommentAdded and its approvals
+    @return Integer number of events that passed
+
+    """
+    start = time.time()
+    passed = sum(1 for event, approvals in events if check(event, approvals))
+    elapsed = time.time() - start
+    print "%-22s %10.0f checks/s  passed %s" % (name, len(events) / elapsed,
+                                                passed)
+    return passed
+
+
+if __name__ == '__main__':
+    args = get_args()
+    log.get_logger().setLevel(getattr(logging, args.log_level.upper()))
+    data = make_data(args.projects)
+
+    start = time.time()
+    conf = config.Config(data)
+    print "Indexed %s projects in %.3fs" % (args.projects,
+                                            time.time() - start)
+
+    events = make_events(args.checks, args.projects, conf)
+
+    def indexed(event, approvals):
+        return (event.is_upstream_project() and
+                event.is_upstream_approved(approvals))
+
+    def walked(event, approvals):
+        return list_walk(data, event.project, approvals)
+
+    run("index + label gate", events, indexed)
+    # The list walk is slow at large project counts, time fewer events
+    run("list walk", events[:max(1, args.checks // 100)], walked)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+Benchmarks Project._sync with the persistent source mirror. A source repo
+and a stand in for gerrit are bare repos in a temporary directory. Gerrit
+is reached through a fake ssh command that runs the git command gerrit
+would run against the local repo instead. Three syncs are timed:
+
+    cold - no mirror yet, the source is cloned
+    warm - the mirror exists and only new commits are fetched
+    reclone - the same new commits but the mirror is removed first, as
+        when every sync cloned the source
+
+The size of what was added to the mirror stands in for the bytes
+transferred from the source.
+
+Usage:
+    python benchmarks/mirror_sync.py [--commits 2000] [--new 20]
+
+"""
+import argparse
+import contextlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from gerrit_python_tools import gerrit  # noqa: E402
+from gerrit_python_tools import mirror  # noqa: E402
+from gerrit_python_tools import state  # noqa: E402
+
+# Stands in for ssh. Runs the quoted git command with its repo path
+# moved under GERRIT_ROOT.
+FAKE_SSH = """#!/bin/sh
+while [ $# -gt 1 ]; do shift; done
+exec sh -c "$(printf '%s' "$1" | sed "s#'/#'$GERRIT_ROOT/#")"
+"""
+
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'Benchmark',
+    'GIT_AUTHOR_EMAIL': 'benchmark@example.com',
+    'GIT_COMMITTER_NAME': 'Benchmark',
+    'GIT_COMMITTER_EMAIL': 'benchmark@example.com'
+}
+
+
+def get_args():
+    """
+    Set up and use the argument parser.
+
+    @return argparse.Namespace
+
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks cold and warm"
+                                     " project syncs.")
+    parser.add_argument('--commits', type=int, default=2000,
+                        help="Commits in the source (default: 2000)")
+    parser.add_argument('--new', type=int, default=20,
+                        help="Commits added before each later sync"
+                        " (default: 20)")
+    parser.add_argument('--blob-size', type=int, default=4096,
+                        help="Bytes changed by each commit (default: 4096)")
+    parser.add_argument('--branches', type=int, default=10,
+                        help="Branches in the source (default: 10)")
+    return parser.parse_args()
+
+
+class FakeRemote(object):
+    """
+    The parts of gerrit.Remote that Project._sync uses.
+
+    """
+    username = 'benchmark'
+    host = 'gerrit.invalid'
+    port = 29418
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+        Context manager standing in for a session slot.
+
+        """
+        yield
+
+
+def add_commits(repo, count, blob_size, branches):
+    """
+    Adds commits to the tip of master of a bare repo with git fast-import
+    and points every branch at the new tip.
+
+    @param repo - String path of a bare repo
+    @param count - Integer number of commits
+    @param blob_size - Integer bytes of random data per commit
+    @param branches - Integer number of branches besides master
+
+    """
+    parent = subprocess.Popen(['git', 'rev-parse', '-q', '--verify',
+                               'refs/heads/master'], cwd=repo,
+                              stdout=subprocess.PIPE).communicate()[0].strip()
+    stream = []
+    for i in range(count):
+        data = os.urandom(blob_size)
+        message = 'Commit %s' % i
+        stream.append('commit refs/heads/master\n')
+        stream.append('committer Benchmark <benchmark@example.com> %d +0000\n'
+                      % (1400000000 + i))
+        stream.append('data %d\n%s\n' % (len(message), message))
+        if i == 0 and parent:
+            stream.append('from %s\n' % parent)
+        stream.append('M 644 inline file-%s\ndata %d\n%s\n'
+                      % (i % 50, len(data), data))
+    for b in range(branches):
+        stream.append('reset refs/heads/branch-%s\nfrom refs/heads/master\n\n'
+                      % b)
+    proc = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=repo,
+                            stdin=subprocess.PIPE)
+    proc.communicate(''.join(stream))
+    if proc.returncode:
+        raise Exception("git fast-import failed")
+
+
+def timed_sync(project, remote, mirrors, store):
+    """
+    Syncs a project and returns how long it took and how much the mirror
+    grew.
+
+    @param project - gerrit.Project
+    @param remote - FakeRemote
+    @param mirrors - mirror.MirrorCache
+    @param store - state.StateStore
+    @return Tuple of Float seconds and Integer bytes
+
+    """
+    path = mirrors.path_for(project.source)
+    before = mirror.dir_size(path) if os.path.isdir(path) else 0
+    start = time.time()
+    project._sync(remote, mirrors, store)
+    elapsed = time.time() - start
+    return elapsed, mirror.dir_size(path) - before
+
+
+if __name__ == '__main__':
+    args = get_args()
+    os.environ.update(GIT_ENV)
+    tmp = tempfile.mkdtemp(prefix='mirror-sync-')
+    try:
+        gerrit_root = os.path.join(tmp, 'gerrit')
+        source = os.path.join(tmp, 'source.git')
+        for repo in (source, os.path.join(gerrit_root, 'demo.git')):
+            subprocess.check_call(['git', 'init', '-q', '--bare', repo])
+
+        ssh = os.path.join(tmp, 'ssh')
+        with open(ssh, 'w') as f:
+            f.write(FAKE_SSH)
+        os.chmod(ssh, 0755)
+        os.environ.update({'GIT_SSH_COMMAND': ssh, 'GIT_SSH_VARIANT': 'ssh',
+                           'GERRIT_ROOT': gerrit_root})
+
+        add_commits(source, args.commits, args.blob_size, args.branches)
+
+        project = gerrit.Project({'name': 'demo',
+                                  'source': 'file://%s' % source,
+                                  'heads': True})
+        remote = FakeRemote()
+        # Maintenance is left out so only the sync itself is timed
+        mirrors = mirror.MirrorCache(os.path.join(tmp, 'mirrors'),
+                                     10 * 1024 ** 3, 10 ** 9)
+        store = state.StateStore(os.path.join(tmp, 'state.db'))
+
+        results = [('cold', timed_sync(project, remote, mirrors, store))]
+
+        add_commits(source, args.new, args.blob_size, args.branches)
+        results.append(('warm', timed_sync(project, remote, mirrors, store)))
+
+        add_commits(source, args.new, args.blob_size, args.branches)
+        shutil.rmtree(mirrors.path_for(project.source))
+        results.append(('reclone',
+                        timed_sync(project, remote, mirrors, store)))
+        store.close()
+
+        print ""
+        print "Source: %s commits, %s more before each later sync" % (
+            args.commits, args.new)
+        for name, (elapsed, size) in results:
+            print "%-8s %8.3fs %12s bytes fetched" % (name, elapsed, size)
+    finally:
+        shutil.rmtree(tmp)
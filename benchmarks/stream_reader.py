@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+Benchmarks the reader used by the gerrit event streams. A local socket
+pair stands in for the ssh channel. Reports the CPU used while waiting on
+an idle stream, how long a stop request takes to be noticed and the
+number of events per second read from a busy stream.
+
+Usage:
+    python benchmarks/stream_reader.py [--idle 5] [--events 200000]
+
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from gerrit_python_tools import gerrit  # noqa: E402
+
+EVENT = ('{"type":"comment-added","change":{"project":"demo","number":"1"},'
+         '"patchSet":{"number":"1"},"author":{"username":"dev"},'
+         '"comment":"Patch Set 1: Code-Review+2","eventCreatedOn":1}\n')
+
+
+def get_args():
+    """
+    Set up and use the argument parser.
+
+    @return argparse.Namespace
+
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks the event"
+                                     " stream reader.")
+    parser.add_argument('--idle', type=float, default=5,
+                        help="Seconds to watch an idle stream (default: 5)")
+    parser.add_argument('--poll', type=float, default=1.0,
+                        help="Read timeout in seconds (default: 1.0)")
+    parser.add_argument('--events', type=int, default=200000,
+                        help="Events to read from a busy stream"
+                        " (default: 200000)")
+    return parser.parse_args()
+
+
+def cpu_time():
+    """
+    Returns the user and system CPU time used by the process.
+
+    @return Float seconds
+
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def reader_pair(poll):
+    """
+    Returns a LineReader on one end of a socket pair and the other end to
+    write events to.
+
+    @param poll - Float read timeout in seconds
+    @return Tuple of gerrit.LineReader and socket
+
+    """
+    read_end, write_end = socket.socketpair()
+    read_end.settimeout(poll)
+    return gerrit.LineReader(read_end), write_end
+
+
+def bench_idle(seconds, poll):
+    """
+    Reads from a stream nothing is written to, the way SSHStream.run does.
+
+    @param seconds - Float seconds to watch the stream
+    @param poll - Float read timeout in seconds
+    @return Tuple of CPU percent while idle and seconds to notice a stop
+
+    """
+    reader, write_end = reader_pair(poll)
+    stop = threading.Event()
+
+    def run():
+        while not stop.is_set():
+            reader.read_lines()
+
+    t = threading.Thread(target=run)
+    t.start()
+    start_cpu = cpu_time()
+    time.sleep(seconds)
+    used = cpu_time() - start_cpu
+
+    stopped = time.time()
+    stop.set()
+    t.join()
+    write_end.close()
+    return 100.0 * used / seconds, time.time() - stopped
+
+
+def bench_busy(count, poll):
+    """
+    Reads count events written as fast as a writer thread can send them.
+
+    @param count - Integer number of events
+    @param poll - Float read timeout in seconds
+    @return Float events per second
+
+    """
+    reader, write_end = reader_pair(poll)
+    batch = EVENT * 100
+
+    def write():
+        for _ in range(count // 100):
+            write_end.sendall(batch)
+        write_end.close()
+
+    t = threading.Thread(target=write)
+    start = time.time()
+    t.start()
+    read = 0
+    try:
+        while True:
+            read += len(reader.read_lines())
+    except EOFError:
+        pass
+    elapsed = time.time() - start
+    t.join()
+    return read / elapsed
+
+
+if __name__ == '__main__':
+    args = get_args()
+    cpu, stop_delay = bench_idle(args.idle, args.poll)
+    print "Idle CPU: %.2f%% over %ss" % (cpu, args.idle)
+    print "Stop noticed after: %.3fs (poll %ss)" % (stop_delay, args.poll)
+    print "Busy stream: %.0f events/s" % bench_busy(args.events, args.poll)
@@ -0,0 +1,153 @@
+"""
+Builds the events a stream missed while it was disconnected. Missed
+comments are found by querying gerrit for recently updated changes and
+missed ref updates by comparing the refs of each source with the refs
+recorded at its last sync. The events are synthesized in the same form
+gerrit streams them so they take the same path as live events.
+
+"""
+import config
+import gerrit
+import git
+import json
+import log
+import re
+import state
+import time
+
+logger = log.get_logger()
+
+# Seconds subtracted from the last event time to allow for clock skew.
+# Backfilled copies of events received live are dropped by the stream.
+MARGIN = 60
+
+# Matches the patchset a review comment was left on
+PATCH_SET_RE = re.compile(r'^Patch Set (\d+)')
+
+# Rev gerrit uses for the missing side of a ref creation or deletion
+NULL_REV = '0' * 40
+
+
+def comment_events(change, since):
+    """
+    Synthesizes comment-added events for the comments on a change made at
+    or after since.
+
+    @param change - Dictionary change from gerrit query with comments and
+        patch sets
+    @param since - Integer unix time
+    @returns - List of event dictionaries
+
+    """
+    patch_sets = dict((int(p['number']), p)
+                      for p in change.get('patchSets', []))
+    if not patch_sets:
+        return []
+
+    change_data = dict((k, v) for k, v in change.items()
+                       if k not in ('comments', 'patchSets'))
+
+    events = []
+    for comment in change.get('comments', []):
+        if int(comment.get('timestamp', 0)) < since:
+            continue
+        message = comment.get('message', '')
+        match = PATCH_SET_RE.match(message)
+        number = int(match.group(1)) if match else max(patch_sets)
+        if number not in patch_sets:
+            continue
+        events.append({
+            'type': 'comment-added',
+            'change': change_data,
+            'patchSet': patch_sets[number],
+            'author': comment.get('reviewer', {}),
+            'comment': message,
+            'eventCreatedOn': comment['timestamp']
+        })
+    return events
+
+
+def downstream_backfill(remote, yaml_file):
+    """
+    Returns a backfill for the downstream stream. It finds comments left
+    on open changes of upstream projects while the stream was down.
+    Every open change updated since is queried, a page at a time, and
+    changes of other projects are skipped locally. Naming each upstream
+    project in the query would exceed gerrit's query limits on large
+    configurations. Upstream projects are read from the current
+    configuration on every backfill.
+
+    @param remote - gerrit.Remote downstream remote
+    @param yaml_file - String location of the configuration
+    @returns - Function taking the Integer unix time of the last event
+        seen and returning a List of raw event lines
+
+    """
+    def backfill(since):
+        projects = config.get_config(yaml_file).upstream_projects
+        if not projects:
+            return []
+        since = since - MARGIN
+        age = max(1, int(time.time() - since))
+        query = 'status:open -age:%ss' % age
+        lines = []
+        options = ['--comments', '--patch-sets']
+        try:
+            for change in gerrit.query_changes(remote.SSH(), query, options):
+                if change.get('project') not in projects:
+                    continue
+                for event in comment_events(change, since):
+                    lines.append(json.dumps(event))
+        except Exception:
+            logger.exception("Backfill query failed")
+        logger.info("Backfilled %s comment(s)" % len(lines))
+        return lines
+
+    return backfill
+
+
+def upstream_backfill(yaml_file):
+    """
+    Returns a backfill for the upstream stream. It compares the refs of
+    each synced project's source with the refs recorded at its last sync
+    and synthesizes ref-updated events for refs that differ. Projects are
+    read from the current configuration on every backfill.
+
+    @param yaml_file - String location of the configuration
+    @returns - Function taking the Integer unix time of the last event
+        seen and returning a List of raw event lines
+
+    """
+    def backfill(since):
+        conf = config.get_config(yaml_file)
+        projects = [p for p in
+                    (gerrit.Project(d) for d in conf.get('projects', []))
+                    if p.source and (p.heads or p.tags)]
+        store = state.get_state_store(conf)
+        now = int(time.time())
+        lines = []
+        for project in projects:
+            try:
+                refs = git.ls_remote(project.source, **project.ref_kwargs())
+            except Exception:
+                logger.exception("Project %s: Unable to list source refs"
+                                 % project.name)
+                continue
+            synced = store.source_refs(project.name) or {}
+            for ref in sorted(set(refs) | set(synced)):
+                if refs.get(ref) == synced.get(ref):
+                    continue
+                lines.append(json.dumps({
+                    'type': 'ref-updated',
+                    'refUpdate': {
+                        'project': project.name,
+                        'refName': ref,
+                        'oldRev': synced.get(ref, NULL_REV),
+                        'newRev': refs.get(ref, NULL_REV)
+                    },
+                    'eventCreatedOn': now
+                }))
+        logger.info("Backfilled %s ref update(s)" % len(lines))
+        return lines
+
+    return backfill
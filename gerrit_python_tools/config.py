@@ -1,3 +1,5 @@
+import os
+import threading
 import yaml
 
 
@@ -21,7 +23,11 @@ def get_default_projects_config():
             'username': 'SomeUser',
             'key_filename': None,
             'timeout': 10,
-            'keepalive': 60
+            'keepalive': 60,
+            'max_connections': 4,
+            'max_channels': 8,
+            'max_sessions': 4,
+            'idle_timeout': 300
         },
         'upstream': {
             'host': '',
@@ -30,14 +36,33 @@ def get_default_projects_config():
             'key_filename': None,
             'timeout': 10,
             'keepalive': 60,
-            'trigger': 'Verified+2'
+            'max_connections': 4,
+            'max_channels': 8,
+            'max_sessions': 4,
+            'idle_timeout': 300,
+            'trigger': 'Verified+2',
+            'approvals_from_event': False,
+            'approval_batch_window': 0.05,
+            'approval_batch_size': 50
         },
         'daemon': {
             'numthreads': 5,
             'sleep': 5,
             'delay': 60 * 2,
             'upstream': True,
-            'sync': True
+            'sync': True,
+            'group_ttl': 300
+        },
+        'cache': {
+            'dir': '~/.cache/gerrit-python-tools',
+            'mirror_size': 10240,
+            'workspace_size': 10240,
+            'maintenance_interval': 60 * 60 * 24
+        },
+        'journal': {
+            'enabled': True,
+            'segment_size': 16,
+            'fsync_interval': 0.05
         },
         'upstream-labels': [
             {
@@ -107,3 +132,141 @@ def load_config(filename, default=None):
     # Update config
     config = merge_dict(config, diff)
     return config
+
+
+class FrozenDict(dict):
+    """
+    Dictionary that can not be modified after it is created.
+
+    """
+    def _read_only(self, *args, **kwargs):
+        """
+        Raises a TypeError for any attempt to modify the dictionary.
+
+        """
+        raise TypeError("Configuration is read only")
+
+    __setitem__ = _read_only
+    __delitem__ = _read_only
+    clear = _read_only
+    pop = _read_only
+    popitem = _read_only
+    setdefault = _read_only
+    update = _read_only
+
+
+def freeze(value):
+    """
+    Recursively converts dictionaries to FrozenDicts and lists to tuples.
+
+    @param value - Value to freeze
+    @return Frozen value
+
+    """
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def label_specs(label_dicts):
+    """
+    Resolves a list of label dictionaries into (name, min, max) tuples.
+
+    @param label_dicts - List of dictionaries with name, min and max keys
+    @return Tuple of (String, Integer, Integer) tuples
+
+    """
+    return tuple((label['name'], int(label['min']), int(label['max']))
+                 for label in label_dicts)
+
+
+class Config(FrozenDict):
+    """
+    Read only configuration. Projects are indexed by name and label specs
+    are resolved per project once when the configuration is created so
+    lookups do not walk the projects list.
+
+    """
+    def __init__(self, data):
+        """
+        Freezes data and builds the indexes.
+
+        @param data - Dictionary configuration
+
+        """
+        super(Config, self).__init__(freeze(data))
+
+        self._projects = {}
+        for project in self.get('projects', ()):
+            if 'name' in project:
+                self._projects[project['name']] = project
+
+        self.upstream_projects = frozenset(
+            name for name, project in self._projects.iteritems()
+            if project.get('upstream', False)
+        )
+
+        self._default_labels = label_specs(self.get('upstream-labels', ()))
+        self._labels = {}
+        for name, project in self._projects.iteritems():
+            label_dicts = project.get('upstream-labels', None)
+            if label_dicts is not None:
+                self._labels[name] = label_specs(label_dicts)
+
+    def project(self, name):
+        """
+        Returns the configuration of a project.
+
+        @param name - String project name
+        @return Dictionary | None if the project is not configured
+
+        """
+        return self._projects.get(name)
+
+    def project_names(self):
+        """
+        Returns the names of all configured projects.
+
+        @return List of Strings
+
+        """
+        return self._projects.keys()
+
+    def label_specs(self, project_name):
+        """
+        Returns the resolved upstream label specs for a project. Projects
+        without their own upstream-labels use the global upstream-labels.
+
+        @param project_name - String project name
+        @return Tuple of (name, min, max) tuples
+
+        """
+        return self._labels.get(project_name, self._default_labels)
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def get_config(filename):
+    """
+    Returns a cached Config for a yaml file. The file is only read again
+    when its modification time or size changes. Safe to call from many
+    threads; the returned Config is shared and read only.
+
+    @param filename - String filename
+    @return Config
+
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    stamp = (stat.st_mtime, stat.st_size)
+    with _cache_lock:
+        cached = _cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        conf = Config(load_config(path))
+        _cache[path] = (stamp, conf)
+        return conf
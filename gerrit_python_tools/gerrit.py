@@ -1,8 +1,9 @@
+import collections
 import git
-import hashlib
 import json
 import log
 import logging
+import mirror
 import os
 import paramiko
 import pipes
@@ -10,10 +11,15 @@ import pprint
 import Queue
 import re
 import shutil
+import socket
+import state
 import StringIO
 import subprocess
+import threading
 import time
 import utils
+import workspace
+from contextlib import contextmanager
 from thread import StoppableThread
 from uuid import uuid4
 from pipes import quote
@@ -24,6 +30,195 @@ log.get_logger('paramiko').setLevel(logging.ERROR)
 # Get a logger
 logger = log.get_logger()
 
+# Max number of refspecs sent in one git push
+PUSH_CHUNK_SIZE = 1000
+
+# Finds the creation time of a raw stream event without decoding it
+EVENT_CREATED_RE = re.compile(r'"eventCreatedOn"\s*:\s*(\d+)')
+
+# Seconds an approval lookup waits on its batch beyond the batch window
+APPROVAL_LOOKUP_TIMEOUT = 300
+
+# Number of recent live event keys a stream remembers to drop backfilled
+# copies of them
+SEEN_EVENTS = 10000
+
+# Matches the change url gerrit reports back when a change is pushed
+CHANGE_URL_RE = re.compile(r'^remote:\s+(https?://\S+)[ \t]*(.*)$', re.M)
+
+
+class LineReader(object):
+    """
+    Reads complete lines from a channel. Data is received in chunks into a
+    reusable buffer and split into lines, holding back any partial line
+    until the rest of it arrives.
+
+    """
+    def __init__(self, channel, chunk_size=32768):
+        """
+        Inits the reader. The channel should have a timeout set so reads
+        do not block forever.
+
+        @param channel - paramiko.Channel or any object with recv(nbytes)
+        @param chunk_size - Integer max bytes to receive per read
+
+        """
+        self._channel = channel
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+
+    def read_lines(self):
+        """
+        Blocks until data is received or the channel times out.
+
+        @returns - List of complete lines without line endings. The list
+            is empty if the read timed out or no line was completed.
+        @raises - EOFError if the channel has been closed.
+
+        """
+        try:
+            data = self._channel.recv(self._chunk_size)
+        except socket.timeout:
+            return []
+        if not data:
+            raise EOFError("Channel closed")
+
+        self._buffer.extend(data)
+        end = self._buffer.rfind('\n')
+        if end < 0:
+            return []
+        lines = str(self._buffer[:end]).split('\n')
+        del self._buffer[:end + 1]
+        return [line.rstrip('\r') for line in lines if line.strip()]
+
+
+def decode_event(json_):
+    """
+    Decodes a raw event line from a gerrit event stream.
+
+    @param json_ - String raw JSON event
+    @returns - JSON loaded object or None if the line is not valid JSON
+
+    """
+    try:
+        event = json.loads(json_)
+    except ValueError:
+        logger.error("Error loading json:\n%s" % json_)
+        return None
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received event:\n%s" % pprint.pformat(event))
+    return event
+
+
+def event_key(event):
+    """
+    Returns a key identifying an event. The same comment or ref update has
+    the same key whether it arrived on the live stream or was backfilled.
+    The creation time is part of the key, so a repeated comment or a ref
+    moving back to an earlier revision is a new event.
+
+    @param event - Decoded event dictionary
+    @returns - Tuple | None if the event type has no key
+
+    """
+    try:
+        created = int(event['eventCreatedOn'])
+        if event.get('type') == 'comment-added':
+            author = event.get('author', {})
+            return ('comment-added',
+                    int(event['change']['number']),
+                    int(event['patchSet']['number']),
+                    author.get('username') or author.get('email'),
+                    event.get('comment', '').strip(),
+                    created)
+        if event.get('type') == 'ref-updated':
+            ref_update = event['refUpdate']
+            return ('ref-updated',
+                    ref_update['project'],
+                    ref_update['refName'],
+                    ref_update['newRev'],
+                    created)
+    except (KeyError, TypeError, ValueError):
+        pass
+    return None
+
+
+class RawEventFilter(object):
+    """
+    Classifies raw event lines from a gerrit event stream without decoding
+    them. Events are dropped when their type, project or text can not
+    matter to the consumer. Anything that can not be classified cheaply is
+    kept so the full decode can make the decision.
+
+    """
+    # Characters that gerrit never escapes in JSON strings
+    _SAFE_TEXT = re.compile(r'^[A-Za-z0-9 +\-_.:]+$')
+    _PROJECT = re.compile(r'(?<!\\)"project"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+    def __init__(self):
+        """
+        Inits the filter with no rules. Events of types without a rule are
+        dropped.
+
+        """
+        self._rules = []
+
+    def add_rule(self, event_type, projects=None, text=None):
+        """
+        Keeps events of a type, optionally only for some projects and
+        only when the raw event contains some text.
+
+        @param event_type - String event type (comment-added, etc)
+        @param projects - Iterable of project names or None for any project
+        @param text - String that must appear in the event or None
+
+        """
+        type_re = re.compile(r'(?<!\\)"type"\s*:\s*"%s"'
+                             % re.escape(event_type))
+        if projects is not None:
+            projects = frozenset(projects)
+        if text is not None and not self._SAFE_TEXT.match(text):
+            # Text may be escaped in the raw event. Leave it for the decode.
+            text = None
+        self._rules.append((type_re, projects, text))
+
+    def __call__(self, line):
+        """
+        Returns whether or not the raw event line should be kept.
+
+        @param line - String raw JSON event
+        @returns - Boolean
+
+        """
+        for type_re, projects, text in self._rules:
+            if not type_re.search(line):
+                continue
+            if text is not None and text not in line:
+                continue
+            if projects is not None:
+                names = self._PROJECT.findall(line)
+                if names and not any(self._unescape(n) in projects
+                                     for n in names):
+                    continue
+            return True
+        return False
+
+    @staticmethod
+    def _unescape(name):
+        """
+        Unescapes a JSON string value if it contains escapes.
+
+        @param name - String raw JSON string contents
+        @returns - String
+
+        """
+        if '\\' not in name:
+            return name
+        try:
+            return json.loads('"%s"' % name)
+        except ValueError:
+            return name
+
 
 class SSHStream(StoppableThread):
     """
@@ -33,13 +228,34 @@ class SSHStream(StoppableThread):
     to the queue.
 
     """
-    def __init__(self, host, port, timeout, username, key_filename, keepalive):
+    def __init__(self, host, port, timeout, username, key_filename, keepalive,
+                 event_types=None, event_filter=None, dispatcher=None,
+                 name=None, journal=None, backfill=None):
         """
         Class constructor. Cleans numbers and starts a queue.
 
+        @param event_types - Iterable of event type names to subscribe to.
+            All events are streamed if None or empty.
+        @param event_filter - Callable taking a raw event line and returning
+            whether it should be queued. All events are queued if None.
+        @param dispatcher - thread.Dispatcher or None. Events are put into
+            the dispatcher under this stream's name instead of the stream's
+            own queue. Events decoded for duplicate checks are put decoded,
+            others as raw lines.
+        @param name - String name of the stream
+        @param journal - journal.Journal or None. Events put into the
+            dispatcher are journaled first.
+        @param backfill - Callable or None. Called after a reconnect with
+            the eventCreatedOn of the last event seen. Should return raw
+            event lines for what was missed while disconnected.
+
         """
         super(SSHStream, self).__init__()
         self._queue = Queue.Queue()
+        self._dispatcher = dispatcher
+        self._journal = journal
+        if name:
+            self.name = name
 
         self._ssh_kwargs = {
             'username': username,
@@ -53,6 +269,32 @@ class SSHStream(StoppableThread):
         self._host = host
         self._keepalive = int(keepalive)
 
+        # Seconds a read may block before checking for a stop request
+        self._poll = 1.0
+
+        self._event_types = sorted(event_types or [])
+        self._event_filter = event_filter
+
+        # Catch up state. Backfills run on their own thread alongside the
+        # live stream so the lock guards what both of them receive.
+        self._backfill = backfill
+        self._receive_lock = threading.Lock()
+        self._last_created = None
+        self._seen = collections.OrderedDict()
+
+    def get_command(self):
+        """
+        Returns the gerrit command that subscribes to the event stream.
+        Only the configured event types are requested from gerrit.
+
+        @returns - String
+
+        """
+        cmd = 'gerrit stream-events'
+        for event_type in self._event_types:
+            cmd += ' -s %s' % quote(event_type)
+        return cmd
+
     def get_event(self):
         """
         Returns an event or None if nothing is in the queue
@@ -61,22 +303,125 @@ class SSHStream(StoppableThread):
 
         """
         try:
-            json_ = self._queue.get_nowait()
-            event = json.loads(json_)
-            logger.debug("Received event:\n%s" % pprint.pformat(event))
-            return event
-        except ValueError:
-            logger.error("Error loading json:\n%s" % json_)
+            item = self._queue.get_nowait()
         except Queue.Empty:
             logger.debug("Nothing in event queue.")
-        return None
+            return None
+        if isinstance(item, dict):
+            return item
+        return decode_event(item)
+
+    def emit(self, line, event=None):
+        """
+        Queues an event that passed the event filter. The raw line is
+        journaled and the decoded event is queued when there is one so it
+        is not decoded again.
+
+        @param line - String raw JSON event
+        @param event - Decoded event dictionary or None
+
+        """
+        item = line if event is None else event
+        if self._dispatcher is not None:
+            seq = None
+            if self._journal is not None:
+                seq = self._journal.append(self.name, line)
+            self._dispatcher.put(self.name, item, seq=seq)
+        else:
+            self._queue.put(item)
+
+    def receive(self, line, backfilled=None):
+        """
+        Handles a raw event line from the live stream or a backfill. The
+        line is dropped if it does not pass the event filter. Live events
+        are never dropped as duplicates, only remembered. A backfilled
+        event is dropped if it was received live or earlier in the same
+        backfill. Safe to call from the stream and backfill threads at
+        once.
+
+        @param line - String raw JSON event
+        @param backfilled - Set of keys of the events backfilled so far by
+            the catch-up the line came from, or None for live events
+
+        """
+        match = EVENT_CREATED_RE.search(line)
+        if match:
+            with self._receive_lock:
+                self._last_created = max(self._last_created,
+                                         int(match.group(1)))
+
+        if self._event_filter and not self._event_filter(line):
+            return
+
+        event = None
+        if self._backfill is not None:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                pass
+            if not isinstance(event, dict):
+                event = None
+            key = event_key(event) if event is not None else None
+            if key is not None and backfilled is None:
+                with self._receive_lock:
+                    self._seen[key] = True
+                    if len(self._seen) > SEEN_EVENTS:
+                        self._seen.popitem(last=False)
+            elif key is not None:
+                with self._receive_lock:
+                    duplicate = key in self._seen
+                if duplicate or key in backfilled:
+                    logger.debug("Dropping duplicate event %s" % (key,))
+                    return
+                backfilled.add(key)
+
+        self.emit(line, event=event)
+
+    def catch_up(self, since):
+        """
+        Backfills events missed since the last event seen before the
+        connection was lost. Backfilled copies of live events are dropped.
+        Errors are logged so the live stream keeps running.
+
+        @param since - Integer eventCreatedOn of the last event seen
+
+        """
+        logger.info("Backfilling events since %s" % since)
+        try:
+            lines = self._backfill(since)
+        except Exception:
+            logger.exception("Unable to backfill events.")
+            return
+        backfilled = set()
+        for line in lines:
+            self.receive(line, backfilled=backfilled)
+
+    def start_catch_up(self):
+        """
+        Starts backfilling on its own thread so the live stream is read
+        while the backfill runs. Nothing is done without a backfill or
+        before the first connection.
+
+        """
+        with self._receive_lock:
+            since = self._last_created
+            if since is None:
+                self._last_created = int(time.time())
+        if self._backfill is None or since is None:
+            return
+        t = threading.Thread(target=self.catch_up, args=(since,),
+                             name='%s-backfill' % self.name)
+        t.daemon = True
+        t.start()
 
     def run(self):
         """
         Run method of the thread contains two loops.
         The outer loop reconnects to gerrit after a period of time
-            if an error occurs.
-        The inner loop reads from the ssh connection.
+            if an error occurs. After a reconnect, events missed while
+            disconnected are backfilled on a separate thread.
+        The inner loop blocks on reads from the ssh connection, waking up
+            at least once per poll interval.
         Both loops check to see if a stop is requested.
 
         """
@@ -91,17 +436,24 @@ class SSHStream(StoppableThread):
 
             try:
                 client.connect(self._host, **(self._ssh_kwargs))
-                client.get_transport().set_keepalive(self._keepalive)
-                _, stdout, _ = client.exec_command('gerrit stream-events')
+                transport = client.get_transport()
+                transport.set_keepalive(self._keepalive)
+                channel = transport.open_session()
+                channel.settimeout(self._poll)
+                channel.exec_command(self.get_command())
+                reader = LineReader(channel)
+
+                # Subscribed before backfilling so nothing falls in between.
+                # Backfilled copies of live events are dropped.
+                self.start_catch_up()
 
                 # Inner loop - Manage reading from stream
-                while not stdout.channel.exit_status_ready():
-                    if stdout.channel.recv_ready():
-                        self._queue.put(stdout.readline())
+                while not self._stop.isSet():
+                    for line in reader.read_lines():
+                        self.receive(line)
 
-                    # Check for break
-                    if self._stop.isSet():
-                        break
+            except EOFError:
+                logger.info("Gerrit event stream closed by remote.")
 
             except Exception:
                 logger.exception("Error listening to gerrit event stream.")
@@ -115,7 +467,312 @@ class SSHStream(StoppableThread):
 
             # Wait 5 seconds before reconnecting. @TODO - Make configurable.
             logger.info("Waiting %s seconds before reconnecting" % 5)
-            time.sleep(5)
+            self._stop.wait(5)
+
+
+class SSHPool(object):
+    """
+    Pool of authenticated paramiko clients for a single gerrit service.
+    Clients are kept alive between commands and each command gets its own
+    channel. Idle or broken clients are evicted and no more than
+    max_connections clients will exist at any one time.
+
+    """
+    def __init__(self, host, port, timeout, username, key_filename,
+                 keepalive, max_connections, idle_timeout):
+        """
+        Inits the pool. No connections are made until one is needed.
+
+        @param host - String Location of gerrit service
+        @param port - String Port of gerrit service (usually 29418)
+        @param timeout - Integer Timeout in seconds
+        @param username - String username
+        @param key_filename - String or None
+        @param keepalive - Integer keepalive interval in seconds
+        @param max_connections - Integer max number of clients to the host
+        @param idle_timeout - Integer seconds a client may sit unused
+
+        """
+        self._ssh_kwargs = {
+            'username': username,
+            'port': int(port),
+            'timeout': int(timeout)
+        }
+
+        if key_filename:
+            self._ssh_kwargs['key_filename'] = key_filename
+
+        self._host = host
+        self._keepalive = int(keepalive)
+        self._max_connections = max(1, int(max_connections))
+        self._idle_timeout = int(idle_timeout)
+
+        # List of (client, last used time) tuples
+        self._idle = []
+
+        # Number of clients in existence, idle or leased
+        self._size = 0
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def is_healthy(client):
+        """
+        Returns whether or not the client's transport is still usable.
+
+        @param client - paramiko.SSHClient
+        @returns - Boolean
+
+        """
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _connect(self):
+        """
+        Creates a new authenticated client.
+
+        @returns - paramiko.SSHClient
+
+        """
+        logger.debug("Opening pooled ssh connection to %s" % self._host)
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(self._host, **(self._ssh_kwargs))
+        if self._keepalive:
+            client.get_transport().set_keepalive(self._keepalive)
+        return client
+
+    def _discard(self, client):
+        """
+        Closes a client and forgets about it. Lock must be held.
+
+        @param client - paramiko.SSHClient
+
+        """
+        self._size -= 1
+        try:
+            client.close()
+        except Exception:
+            logger.debug("Error closing pooled ssh connection",
+                         exc_info=True)
+
+    def _evict(self):
+        """
+        Discards idle clients that are broken or have been idle for too
+        long. Lock must be held.
+
+        """
+        now = time.time()
+        keep = []
+        for client, last_used in self._idle:
+            if now - last_used > self._idle_timeout:
+                logger.debug("Evicting idle ssh connection to %s"
+                             % self._host)
+                self._discard(client)
+            elif not self.is_healthy(client):
+                logger.debug("Evicting broken ssh connection to %s"
+                             % self._host)
+                self._discard(client)
+            else:
+                keep.append((client, last_used))
+        self._idle = keep
+
+    def acquire(self):
+        """
+        Leases a healthy client from the pool. Creates a new client if
+        none are idle and the pool is not full. Waits for a client to be
+        released otherwise.
+
+        @returns - paramiko.SSHClient
+
+        """
+        with self._cond:
+            while True:
+                self._evict()
+                if self._idle:
+                    client, _ = self._idle.pop()
+                    return client
+                if self._size < self._max_connections:
+                    self._size += 1
+                    break
+                self._cond.wait(1)
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, client, broken=False):
+        """
+        Returns a leased client to the pool.
+
+        @param client - paramiko.SSHClient
+        @param broken - Boolean True if the client should be discarded
+
+        """
+        with self._cond:
+            if broken or not self.is_healthy(client):
+                self._discard(client)
+            else:
+                self._idle.append((client, time.time()))
+            self._cond.notify()
+
+    def close(self):
+        """
+        Closes all idle clients.
+
+        """
+        with self._cond:
+            for client, _ in self._idle:
+                self._discard(client)
+            self._idle = []
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(remote):
+    """
+    Returns the shared SSHPool for a remote. Remotes with the same
+    connection information share a pool.
+
+    @param remote - gerrit.Remote object
+    @returns - gerrit.SSHPool
+
+    """
+    key = (remote.host, int(remote.port), remote.username,
+           remote.key_filename)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = SSHPool(
+                remote.host,
+                remote.port,
+                remote.timeout,
+                remote.username,
+                remote.key_filename,
+                remote.keepalive,
+                remote.max_connections,
+                remote.idle_timeout
+            )
+            _pools[key] = pool
+        return pool
+
+
+def start_command(transport, cmd):
+    """
+    Starts a command on a new channel of an existing transport without
+    waiting for it to finish.
+
+    @param transport - paramiko.Transport
+    @param cmd - String command to execute.
+    @returns - paramiko.Channel
+
+    """
+    channel = transport.open_session()
+    try:
+        channel.exec_command(cmd)
+    except Exception:
+        channel.close()
+        raise
+    return channel
+
+
+def finish_command(channel):
+    """
+    Waits for a command started with start_command to finish and
+    closes its channel.
+
+    @param channel - paramiko.Channel
+    @return Two tuple comprised of the return code and stdout if
+        the return code is 0. Returns the stderr if the retcode
+        is non zero
+
+    """
+    try:
+        stdout = channel.makefile('rb', -1).read()
+        stderr = channel.makefile_stderr('rb', -1).read()
+        retcode = channel.recv_exit_status()
+    finally:
+        channel.close()
+    output = stdout if not retcode else stderr
+    return retcode, output
+
+
+_session_limits = {}
+
+
+def get_session_limit(remote):
+    """
+    Returns the shared semaphore capping concurrent git sessions to a
+    remote. Remotes with the same host and port share a semaphore.
+
+    @param remote - gerrit.Remote object
+    @returns - threading.BoundedSemaphore
+
+    """
+    key = (remote.host, int(remote.port))
+    with _pools_lock:
+        limit = _session_limits.get(key)
+        if limit is None:
+            limit = threading.BoundedSemaphore(int(remote.max_sessions))
+            _session_limits[key] = limit
+        return limit
+
+
+def exec_command(transport, cmd):
+    """
+    Runs a command on a new channel of an existing transport.
+
+    @param transport - paramiko.Transport
+    @param cmd - String command to execute.
+    @return Two tuple comprised of the return code and stdout if
+        the return code is 0. Returns the stderr if the retcode
+        is non zero
+
+    """
+    return finish_command(start_command(transport, cmd))
+
+
+def query_changes(ssh, query, options=None):
+    """
+    Runs a gerrit query and yields the changes it matches as they are
+    read. Pages are followed with --start for as long as gerrit reports
+    moreChanges. Stopping iteration early closes the query without
+    reading the rest of its output.
+
+    @param ssh - gerrit.SSH object
+    @param query - String gerrit query
+    @param options - List of String query options such as --patch-sets
+    @yields - Dictionary change
+
+    """
+    start = 0
+    while True:
+        cmd = 'gerrit query --format JSON'
+        for option in options or []:
+            cmd += ' %s' % option
+        if start:
+            cmd += ' --start %s' % start
+        cmd += ' %s' % quote(query)
+
+        count = 0
+        more = False
+        with ssh.stream(cmd) as results:
+            for json_ in results:
+                if json_.get('type') == 'stats':
+                    more = json_.get('moreChanges', False)
+                    continue
+                count += 1
+                yield json_
+
+        if not more or not count:
+            return
+        start += count
 
 
 class SSH(object):
@@ -123,7 +780,8 @@ class SSH(object):
     Class for connecting to a gerrit service via ssh and paramiko.
 
     """
-    def __init__(self, host, port, timeout, username, key_filename):
+    def __init__(self, host, port, timeout, username, key_filename,
+                 pool=None, max_channels=1):
         """
         Inits the SSH object.
 
@@ -132,6 +790,10 @@ class SSH(object):
         @param timeout - Integer Timeout in seconds
         @param username - String username
         @param key_filename - String or None
+        @param pool - gerrit.SSHPool or None. Without a pool a new
+            connection is made for every command.
+        @param max_channels - Integer default number of commands exec_many
+            keeps in flight over one connection.
 
         """
         self._ssh_kwargs = {
@@ -144,6 +806,40 @@ class SSH(object):
             self._ssh_kwargs['key_filename'] = key_filename
 
         self._host = host
+        self._pool = pool
+        self._max_channels = max(1, int(max_channels))
+
+    @contextmanager
+    def _client(self):
+        """
+        Context manager providing a connected client. The client is leased
+        from the pool if there is one, otherwise a new client is made and
+        closed afterwards.
+
+        @yields - paramiko.SSHClient
+
+        """
+        if self._pool:
+            client = self._pool.acquire()
+            broken = False
+            try:
+                yield client
+            except Exception:
+                broken = True
+                raise
+            finally:
+                # Also reached when a generator using the client is closed
+                self._pool.release(client, broken=broken)
+        else:
+            client = paramiko.SSHClient()
+            client.load_system_host_keys()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+            client.connect(self._host, **(self._ssh_kwargs))
+            try:
+                yield client
+            finally:
+                client.close()
 
     def exec_once(self, cmd):
         """
@@ -156,20 +852,70 @@ class SSH(object):
 
         """
         logger.debug("Executing: %s" % cmd)
-        client = paramiko.SSHClient()
-        client.load_system_host_keys()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-        client.connect(self._host, **(self._ssh_kwargs))
-        _, stdout, stderr = client.exec_command(cmd)
-
-        retcode = stdout.channel.recv_exit_status()
-        stream = stdout if not retcode else stderr
-        output = stream.read()
-        client.close()
+        with self._client() as client:
+            retcode, output = exec_command(client.get_transport(), cmd)
         logger.debug(output)
         return retcode, output
 
+    @contextmanager
+    def stream(self, cmd):
+        """
+        Context manager that runs a command printing one JSON object per
+        line and yields a lazy utils.MultiJSON reading straight from the
+        channel. Iterating it keeps no decoded objects. Leaving the context
+        early closes the channel without reading the rest of the output.
+
+        @param cmd - String command to execute.
+        @yields - utils.MultiJSON
+        @raises - Exception if all output was read and the command failed
+
+        """
+        logger.debug("Executing: %s" % cmd)
+        error = None
+        with self._client() as client:
+            channel = start_command(client.get_transport(), cmd)
+            try:
+                results = utils.MultiJSON(channel.makefile('rb', -1))
+                yield results
+                # Only wait on the exit status once gerrit is done writing
+                if results.exhausted and channel.recv_exit_status():
+                    error = channel.makefile_stderr('rb', -1).read()
+            finally:
+                channel.close()
+        if error is not None:
+            raise Exception("Error executing %s: %s" % (cmd, error))
+
+    def exec_many(self, cmds, window=None):
+        """
+        Executes a batch of commands as parallel channels over a single
+        connection. No more than window commands are in flight at once.
+
+        @param cmds - List of String commands to execute.
+        @param window - Integer max commands in flight. Defaults to
+            max_channels.
+        @return List of (retcode, output) tuples in the same order as cmds.
+
+        """
+        window = max(1, int(window or self._max_channels))
+        results = []
+        in_flight = collections.deque()
+        with self._client() as client:
+            transport = client.get_transport()
+            try:
+                for cmd in cmds:
+                    if len(in_flight) >= window:
+                        results.append(finish_command(in_flight.popleft()))
+                    logger.debug("Executing: %s" % cmd)
+                    in_flight.append(start_command(transport, cmd))
+                while in_flight:
+                    results.append(finish_command(in_flight.popleft()))
+            finally:
+                for channel in in_flight:
+                    channel.close()
+        for _, output in results:
+            logger.debug(output)
+        return results
+
 
 class Remote(object):
     """
@@ -182,7 +928,8 @@ class Remote(object):
         Inits the remote.
 
         @param _config - Dictionary containing keys for host, port, timeout,
-            username, key_filename, and keepalive
+            username, key_filename, keepalive, max_connections,
+            max_channels, max_sessions and idle_timeout
 
         """
         self.host = _config['host']
@@ -191,36 +938,239 @@ class Remote(object):
         self.username = _config['username']
         self.key_filename = _config['key_filename']
         self.keepalive = _config['keepalive']
+        self.max_connections = _config['max_connections']
+        self.max_channels = _config['max_channels']
+        self.max_sessions = _config['max_sessions']
+        self.idle_timeout = _config['idle_timeout']
+
+    def SSHStream(self, event_types=None, event_filter=None, dispatcher=None,
+                  name=None, journal=None, backfill=None):
+        """
+        Returns a gerrit.SSHStream object
+
+        @param event_types - Iterable of event type names to subscribe to.
+            All events are streamed if None or empty.
+        @param event_filter - Callable taking a raw event line and returning
+            whether it should be queued.
+        @param dispatcher - thread.Dispatcher to push raw events into
+        @param name - String name of the stream
+        @param journal - journal.Journal to record events in or None
+        @param backfill - Callable returning raw events missed since a
+            time or None
+        @returns - gerrit.SSHStream
+
+        """
+        return SSHStream(
+            self.host,
+            self.port,
+            self.timeout,
+            self.username,
+            self.key_filename,
+            self.keepalive,
+            event_types=event_types,
+            event_filter=event_filter,
+            dispatcher=dispatcher,
+            name=name,
+            journal=journal,
+            backfill=backfill
+        )
+
+    def SSH(self):
+        """
+        Returns a gerrit.SSH object that runs commands over this remote's
+        pooled connections.
+
+        @returns - gerrit.SSH
+        """
+        return SSH(
+            self.host,
+            self.port,
+            self.timeout,
+            self.username,
+            self.key_filename,
+            pool=get_pool(self),
+            max_channels=self.max_channels
+        )
+
+    @contextmanager
+    def session(self):
+        """
+        Context manager that holds one of this remote's session slots.
+        Wrap git operations that open their own ssh connection to the
+        remote so concurrent work never exceeds max_sessions.
+
+        """
+        limit = get_session_limit(self)
+        limit.acquire()
+        try:
+            yield
+        finally:
+            limit.release()
+
+    def exec_many(self, cmds, window=None):
+        """
+        Executes a batch of commands multiplexed over one pooled
+        connection.
+
+        @param cmds - List of String commands to execute.
+        @param window - Integer max commands in flight. Defaults to
+            max_channels.
+        @return List of (retcode, output) tuples in the same order as cmds.
+
+        """
+        return self.SSH().exec_many(cmds, window=window)
+
+
+class ApprovalBatcher(object):
+    """
+    Merges approval lookups made at about the same time into one gerrit
+    query. Queries run on a batch thread of their own. Once a lookup
+    arrives it waits for the batch window and then queries for every
+    change looked up meanwhile, OR'd together. Each waiting caller gets
+    its own change back. Lookups arriving while a query runs make up the
+    next batch.
+
+    """
+    def __init__(self, remote, window, max_batch):
+        """
+        Inits the batcher. The batch thread is started by the first lookup.
+
+        @param remote - gerrit.Remote to query
+        @param window - Number of seconds to wait for more lookups
+        @param max_batch - Integer max number of changes in one query
+
+        """
+        self._remote = remote
+        self._window = float(window)
+        self._max_batch = max(1, int(max_batch))
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._pending = []
+        self._thread = None
+        self.queries = 0
+
+    def lookup(self, change_id, branch, project):
+        """
+        Returns the change with all approvals, waiting for it to be queried
+        along with any other lookups in the same batch.
+
+        @param change_id - String change id
+        @param branch - String branch of the change
+        @param project - String project of the change
+        @returns - Dictionary change or None if gerrit did not return it
+        @raises - Exception if the query failed or did not finish within
+            APPROVAL_LOOKUP_TIMEOUT seconds
+
+        """
+        request = {
+            'key': (change_id, branch, project),
+            'done': threading.Event(),
+            'change': None,
+            'error': None
+        }
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='approval-batcher')
+                self._thread.daemon = True
+                self._thread.start()
+            self._pending.append(request)
+            self._cond.notify()
+
+        if not request['done'].wait(self._window + APPROVAL_LOOKUP_TIMEOUT):
+            with self._lock:
+                self._pending = [r for r in self._pending
+                                 if r is not request]
+            raise Exception("Change %s: Timed out waiting for approvals"
+                            % change_id)
+        if request['error'] is not None:
+            raise request['error']
+        return request['change']
+
+    def _run(self):
+        """
+        Runs the batch thread. Waits for lookups and queries them in
+        batches. The window is only waited for when the thread was idle.
+        A batch whose query fails unexpectedly is failed so its callers
+        don't wait for it.
+
+        """
+        while True:
+            with self._cond:
+                idle = not self._pending
+                while not self._pending:
+                    self._cond.wait()
+            if idle:
+                time.sleep(self._window)
+
+            with self._lock:
+                batch = self._pending[:self._max_batch]
+                del self._pending[:self._max_batch]
+            if not batch:
+                continue
+
+            try:
+                self._query(batch)
+            except Exception as e:
+                logger.exception("Unable to query approvals")
+                for request in batch:
+                    if not request['done'].is_set():
+                        request['error'] = e
+                        request['done'].set()
+
+    def _query(self, batch):
+        """
+        Runs a single query for a batch of lookups and hands each lookup
+        its change.
+
+        @param batch - List of lookup request dictionaries
+
+        """
+        keys = sorted(set(r['key'] for r in batch))
+        query = ' OR '.join('(change:%s branch:%s project:%s)' % key
+                            for key in keys)
+        changes = {}
+        error = None
+        try:
+            self.queries += 1
+            for json_ in query_changes(self._remote.SSH(), query,
+                                       ['--all-approvals']):
+                key = (json_.get('id'), json_.get('branch'),
+                       json_.get('project'))
+                changes[key] = json_
+        except Exception as e:
+            error = e
+        logger.debug("Queried approvals of %s change(s) for %s lookup(s)"
+                     % (len(keys), len(batch)))
+
+        for request in batch:
+            request['change'] = changes.get(request['key'])
+            request['error'] = error
+            request['done'].set()
+
 
-    def SSHStream(self):
-        """
-        Returns a gerrit.SSHStream object
+_batchers = {}
+_batchers_lock = threading.Lock()
 
-        @returns - gerrit.SSHStream
 
-        """
-        return SSHStream(
-            self.host,
-            self.port,
-            self.timeout,
-            self.username,
-            self.key_filename,
-            self.keepalive
-        )
+def get_approval_batcher(remote, window, max_batch):
+    """
+    Returns the shared ApprovalBatcher for a remote. Remotes with the same
+    host and port share a batcher.
 
-    def SSH(self):
-        """
-        Returns a gerrit.SSH object
+    @param remote - gerrit.Remote object
+    @param window - Number of seconds to wait for more lookups
+    @param max_batch - Integer max number of changes in one query
+    @returns - gerrit.ApprovalBatcher
 
-        @returns - gerrit.SSH
-        """
-        return SSH(
-            self.host,
-            self.port,
-            self.timeout,
-            self.username,
-            self.key_filename
-        )
+    """
+    key = (remote.host, int(remote.port))
+    with _batchers_lock:
+        batcher = _batchers.get(key)
+        if batcher is None:
+            batcher = ApprovalBatcher(remote, window, max_batch)
+            _batchers[key] = batcher
+        return batcher
 
 
 class Approval(object):
@@ -316,6 +1266,80 @@ class Label(object):
         return False
 
 
+class LabelGate(object):
+    """
+    Precompiled set of labels that must be approved before a change can be
+    sent upstream. Emulates the MaxWithBlock gerrit function for each label
+    in a single pass over the approvals.
+
+    """
+    def __init__(self, specs):
+        """
+        Inits the gate.
+
+        @param specs - Iterable of (name, min, max) tuples
+
+        """
+        self._specs = dict((name, (min_, max_)) for name, min_, max_ in specs)
+
+    def label_states(self, approvals):
+        """
+        Returns whether or not each label is approved. A label needs the
+        highest value and must not have the lowest value.
+
+        @param approvals - List of Approvals
+        @returns - Dictionary of Booleans keyed by label name
+
+        """
+        passed = set()
+        blocked = set()
+        for approval in approvals:
+            spec = self._specs.get(approval.name)
+            if spec is None:
+                continue
+            value = approval.value
+            if value <= spec[0]:
+                blocked.add(approval.name)
+            elif value >= spec[1]:
+                passed.add(approval.name)
+        return dict((name, name in passed and name not in blocked)
+                    for name in self._specs)
+
+    def approved(self, approvals):
+        """
+        Returns whether or not every label is approved.
+
+        @param approvals - List of Approvals
+        @returns - Boolean
+
+        """
+        return all(self.label_states(approvals).itervalues())
+
+    def evaluate(self, approvals):
+        """
+        Evaluates a possibly incomplete set of approvals. Any label with
+        its lowest value fails the gate. The gate passes if every label has
+        its highest value. Otherwise missing votes might change the result.
+
+        @param approvals - List of Approvals
+        @returns - Boolean | None if the approvals can't decide the gate
+
+        """
+        decided = set()
+        for approval in approvals:
+            spec = self._specs.get(approval.name)
+            if spec is None:
+                continue
+            value = approval.value
+            if value <= spec[0]:
+                return False
+            if value >= spec[1]:
+                decided.add(approval.name)
+        if len(decided) == len(self._specs):
+            return True
+        return None
+
+
 class CommentAdded(object):
     """
     Models CommentAdded type gerrit events.
@@ -327,7 +1351,7 @@ class CommentAdded(object):
         Inits the object.
 
         @param data - Dictionary
-        @param conf - Dictionary
+        @param conf - config.Config
         """
         self._data = data
         self._conf = conf
@@ -362,6 +1386,31 @@ class CommentAdded(object):
         """
         return int(self._data['patchSet'].get('number'))
 
+    @property
+    def subject(self):
+        """
+        Returns the subject of the change
+
+        @returns - String | None
+
+        """
+        return self._data['change'].get('subject')
+
+    @property
+    def patchset_ref(self):
+        """
+        Returns the ref of the patchset, such as refs/changes/45/12345/2
+
+        @returns - String
+
+        """
+        ref = self._data['patchSet'].get('ref')
+        if ref:
+            return ref
+        number = int(self._data['change']['number'])
+        return 'refs/changes/%02d/%s/%s' % (number % 100, number,
+                                            self.patchset_id)
+
     @property
     def project(self):
         """
@@ -432,6 +1481,17 @@ class CommentAdded(object):
         """
         return self._data['change']['owner'].get('email')
 
+    @property
+    def approvals(self):
+        """
+        Returns the approvals carried by the event.
+
+        @returns - List of Approvals
+
+        """
+        return [Approval(a) for a in self._data.get('approvals', [])
+                if a.get('type') and a.get('value') is not None]
+
     def is_upstream_project(self):
         """
         Returns whether or not this project is an upstream project.
@@ -441,22 +1501,14 @@ class CommentAdded(object):
         @returns Boolean
 
         """
-        project = None
-
-        # Iterate over projects in config looking for one with a matching name
-        for p in self._conf.get('projects', []):
-            if p.get('name') == self.project:
-                project = Project(p)
-                break
-
-        # If project not set, then project wasn't found
-        if not project:
+        # If the project isn't in the config it can't be upstream
+        if self._conf.project(self.project) is None:
             logger.debug("Change %s: Project %s not in configuration."
                          % (self.change_id, self.project))
             return False
 
         # Check upstream designation
-        if not project.upstream:
+        if self.project not in self._conf.upstream_projects:
             logger.debug("Change %s: Project %s not designated as upstream."
                          % (self.change_id, self.project))
             return False
@@ -488,55 +1540,74 @@ class CommentAdded(object):
         @returns - Boolean
 
         """
-        labels = get_labels_for_upstream(self._conf, self.project)
-
-        for approval in approvals:
-            label = labels.get(approval.name)
-            if label:
-                label.add_approval(approval)
+        gate = get_label_gate(self._conf, self.project)
+        states = gate.label_states(approvals)
 
         # Debugging
-        for label in labels.values():
-            if label.approved():
-                str_ = "approved"
-            else:
-                str_ = "not approved"
-            logger.debug("Change %s: Label %s is %s"
-                         % (self.change_id, label.name, str_))
+        if logger.isEnabledFor(logging.DEBUG):
+            for name, approved in states.iteritems():
+                str_ = "approved" if approved else "not approved"
+                logger.debug("Change %s: Label %s is %s"
+                             % (self.change_id, name, str_))
+
+        return all(states.itervalues())
+
+    def is_upstream_approved_by_event(self):
+        """
+        Examines the approvals embedded in the comment-added event.
+        The event only carries the votes of the comment's author, so a
+        decision is only made when every label has been decided by them.
+
+        @returns - Boolean | None if the event can't decide the gate
 
-        return all([l.approved() for l in labels.values()])
+        """
+        approvals = self.approvals
+        if not approvals:
+            logger.debug("Change %s: Event carries no approvals"
+                         % self.change_id)
+            return None
+
+        gate = get_label_gate(self._conf, self.project)
+        approved = gate.evaluate(approvals)
+        if approved is None:
+            logger.debug("Change %s: Event approvals incomplete"
+                         % self.change_id)
+        return approved
 
-    def get_approvals(self, ssh):
+    def get_approvals(self, ssh, batcher=None):
         """
         Returns a list of approvals or the empty list for the change
 
         @param ssh - gerrit.SSH object
+        @param batcher - gerrit.ApprovalBatcher or None. The change is
+            looked up through the batcher instead of its own query.
         @returns - List of approvals
         """
         approvals = []
-        cmd = ('gerrit query change:%s branch:%s project:%s'
-               ' --all-approvals limit:1 --format JSON')
-        cmd = cmd % (self.change_id, self.branch, self.project)
+        query = 'change:%s branch:%s project:%s limit:1'
+        query = query % (self.change_id, self.branch, self.project)
         try:
-            retcode, out = ssh.exec_once(cmd)
-
-            # Raise exception if nonzero retcode.
-            # @TODO - Clean this exception handling up.
-            if retcode:
+            json_ = None
+            if batcher is not None:
+                json_ = batcher.lookup(self.change_id, self.branch,
+                                       self.project)
+            else:
+                # Only the first change is needed, stop reading after it
+                for json_ in query_changes(ssh, query, ['--all-approvals']):
+                    break
+            if json_ is None:
                 raise Exception("Change %s: Error getting approvals"
                                 % self.change_id)
 
-            # Grab the first json object. Query returns 1+
-            json_ = utils.MultiJSON(out)[0]
             for patchset in json_['patchSets']:
                 if int(patchset['number']) == self.patchset_id:
                     for json_approval in patchset['approvals']:
-                        logger.debug(pprint.pformat(json_approval))
                         approvals.append(Approval(json_approval))
 
-            logger.debug("Change %s: Approvals returned by gerrit query"
-                         % self.change_id)
-            logger.debug(pprint.pformat(json_))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Change %s: Approvals returned by gerrit query"
+                             % self.change_id)
+                logger.debug(pprint.pformat(json_))
 
         except:
             logger.exception("Change %s: Error getting approvals"
@@ -555,22 +1626,18 @@ class CommentAdded(object):
 
         """
         ssh = upstream.SSH()
-        cmd = 'gerrit query change:%s branch:%s project:%s --format JSON'
-        cmd = cmd % (self.change_id, self.branch, self.project)
+        query = 'change:%s branch:%s project:%s'
+        query = query % (self.change_id, self.branch, self.project)
         url = None
         try:
-            retcode, out = ssh.exec_once(cmd)
-            # Check retcode
-            if retcode:
+            # Only the first change is needed, stop reading after it
+            json_ = None
+            for json_ in query_changes(ssh, query):
+                break
+            # Check that a match was found
+            if json_ is None:
                 return None
-
-            if not retcode:
-                json_ = utils.MultiJSON(out)
-                # Check that a match was found. A stats object will always
-                # be sent. need length > 1
-                if len(json_) < 2:
-                    return None
-                url = json_[0]['url']
+            url = json_['url']
         except Exception:
             logger.exception("Exception getting upstream url")
 
@@ -598,11 +1665,31 @@ class CommentAdded(object):
             logger.debug("Change %s: Upstream not indicated" % self.change_id)
             return
 
-        # Grab all of the approvals
-        approvals = self.get_approvals(downstream.SSH())
+        # A replayed or repeated comment should not send a revision twice
+        store = state.get_state_store(self._conf)
+        if store.upstreamed(self.revision):
+            logger.info("Change %s: Revision %s already sent upstream"
+                        % (self.change_id, self.revision))
+            return
+
+        # Try the approvals carried by the event before querying gerrit
+        approved = None
+        if self._conf['upstream']['approvals_from_event']:
+            approved = self.is_upstream_approved_by_event()
+
+        if approved is None:
+            # Grab all of the approvals, batched with concurrent lookups
+            batcher = None
+            window = self._conf['upstream']['approval_batch_window']
+            if window:
+                batcher = get_approval_batcher(
+                    downstream, window,
+                    self._conf['upstream']['approval_batch_size'])
+            approvals = self.get_approvals(ssh, batcher=batcher)
+            approved = self.is_upstream_approved(approvals)
 
         # Check to see if comment has necessary approvals.
-        if not self.is_upstream_approved(approvals):
+        if not approved:
             msg = ("Could not send to upstream: One or more labels"
                    " not approved.")
             logger.debug("Change %s: %s" % (self.change_id, msg))
@@ -613,116 +1700,103 @@ class CommentAdded(object):
         # Do some git stuffs to push upstream
         logger.debug("Change %s: Sending to upstream" % self.change_id)
 
-        repo_dir = '~/tmp'
-        repo_dir = os.path.expanduser(repo_dir)
-        repo_dir = os.path.abspath(repo_dir)
-
-        # Add uuid, want a unique directory here
-        uuid_dir = str(uuid4())
-        repo_dir = os.path.join(repo_dir, uuid_dir)
-
-        # Make Empty directory - We want this to stop and fail on OSError
-        if not os.path.isdir(repo_dir):
-            os.makedirs(repo_dir)
-            logger.debug(
-                "Change %s: Created directory %s" % (self.change_id, repo_dir)
-            )
-
-        # Save the current working directory
-        old_cwd = os.getcwd()
-
+        # Figure out what user we will pose as
+        # This every upstream user sharing the same key is kinda shady.
+        # Default back to the configured user if username doesnt exist.
+        # should fail in this case
+        username = self.change_owner_username
+        name = self.change_owner_name
+        email = self.change_owner_email
+        if not username:
+            logger.debug("Change %s: Unable to use author credentials."
+                         " Defaulting to configured credentials."
+                         % self.change_id)
+            username = upstream.username
+            name = self._conf['git-config']['name']
+            email = self._conf['git-config']['email']
+
+        # Remotes for upstream and downstream
+        remote_url = "ssh://%s@%s:%s/%s"
+        remotes = {
+            'downstream': remote_url % (downstream.username,
+                                        downstream.host,
+                                        downstream.port,
+                                        self.project),
+            'upstream': remote_url % (username,
+                                      upstream.host,
+                                      upstream.port,
+                                      self.project)
+        }
+        logger.debug('Change %s: Sending upstream as '
+                     'username %s, email %s, name %s'
+                     % (self.change_id, username, email, name))
+
+        # Borrow objects from the mirror of the project's source if any
+        mirror_path = None
+        project = self._conf.project(self.project) or {}
+        if project.get('source'):
+            mirror_path = mirror.get_mirror_cache(self._conf).path_for(
+                project['source'])
+
+        workspaces = workspace.get_workspace_pool(self._conf)
         try:
-            # Change to newly created directory.
-            os.chdir(repo_dir)
-
-            # Init the cwd
-            git.init()
-
-            # Add the remotes for upstream and downstream
-            remote_url = "ssh://%s@%s:%s/%s"
-            git.add_remote('downstream', remote_url % (downstream.username,
-                                                       downstream.host,
-                                                       downstream.port,
-                                                       self.project))
-
-            # Figure out what user we will pose as
-            # This every upstream user sharing the same key is kinda shady.
-            # Default back to the configured user if username doesnt exist.
-            # should fail in this case
-            username = self.change_owner_username
-            name = self.change_owner_name
-            email = self.change_owner_email
-            if not username:
-                logger.debug("Change %s: Unable to use author credentials."
-                             " Defaulting to configured credentials."
-                             % self.change_id)
-                username = upstream.username
-                name = self._conf['git-config']['name']
-                email = self._conf['git-config']['email']
-
-            git.add_remote('upstream', remote_url % (username,
-                                                     upstream.host,
-                                                     upstream.port,
-                                                     self.project))
-            logger.debug('Change %s: Sending upstream as '
-                         'username %s, email %s, name %s'
-                         % (self.change_id, username, email, name))
-            try:
-                env = get_review_env()
-
+            with workspaces.lease(self.project, remotes,
+                                  mirror_path=mirror_path) as repo_dir:
                 # Set committer info
-                git.set_config('user.email', email)
-                git.set_config('user.name', name)
-
-                # Download  specific change to local
-                args = ['git-review', '-r', 'downstream', '-d',
-                        '%s,%s' % (self.change_id, self.patchset_id)]
-                logger.debug('Change %s: running: %s'
-                             % (self.change_id, ' '.join(args)))
-                out = subprocess.check_output(args,
-                                              stderr=subprocess.STDOUT,
-                                              env=env)
-                logger.debug("Change %s: %s" % (self.change_id, out))
-
-                # Send downloaded change to upstream
-                args = ['git-review', '-y', '-r', 'upstream', self.branch,
-                        '-t', self.topic]
-                logger.debug('Change %s: running: %s'
-                             % (self.change_id, ' '.join(args)))
-                out = subprocess.check_output(args,
-                                              stderr=subprocess.STDOUT,
-                                              env=env)
+                git.set_config('user.email', email, cwd=repo_dir)
+                git.set_config('user.name', name, cwd=repo_dir)
+
+                # Fetch only the patchset being sent
+                logger.debug('Change %s: fetching %s'
+                             % (self.change_id, self.patchset_ref))
+                workspaces.checkout(repo_dir, 'downstream', self.patchset_ref)
+
+                # Send fetched change to upstream
+                logger.debug('Change %s: pushing to refs/for/%s'
+                             % (self.change_id, self.branch))
+                out = git.push_for_review('upstream', self.branch,
+                                          topic=self.topic, cwd=repo_dir)
                 logger.debug("Change %s: %s" % (self.change_id, out))
 
+            upstream_url = parse_change_url(out, subject=self.subject)
+            if not upstream_url:
                 upstream_url = self.get_upstream_url(upstream)
 
-                msg = 'Sent to upstream: %s' % (upstream_url)
-                # Send comment to downstream gerrit with link to change in
-                # upstream gerrit
-                ssh.exec_once('gerrit review -m %s %s'
-                              % (pipes.quote(msg), self.revision))
-
-            except subprocess.CalledProcessError as e:
-                msg = "Could not send to upstream:\n%s" % e.output
-                ssh.exec_once('gerrit review -m %s %s'
-                              % (pipes.quote(msg), self.revision))
-                logger.error("Change %s: Unable to send to upstream"
-                             % self.change_id)
-                logger.error("Change %s: %s" % (self.change_id, out))
-
+            # The change is already upstream. Failing to record it must not
+            # be reported as a failed send.
+            try:
+                store.set_upstreamed(self.revision, self.project,
+                                     self.change_id, upstream_url)
             except Exception:
-                msg = 'Could not send to upstream: Error running git-review'
-                ssh.exec_once('gerrit review -m %s %s'
-                              % (pipes.quote(msg), self.revision))
-                logger.exception("Change %s: Unable to send to upstream"
-                                 % self.change_id)
+                logger.exception("Change %s: Unable to record revision %s"
+                                 " as sent upstream"
+                                 % (self.change_id, self.revision))
 
-        finally:
-            # Change to old current working directory
-            os.chdir(old_cwd)
+            msg = 'Sent to upstream: %s' % (upstream_url)
+            # Send comment to downstream gerrit with link to change in
+            # upstream gerrit
+            ssh.exec_once('gerrit review -m %s %s'
+                          % (pipes.quote(msg), self.revision))
 
-            # Attempt to clean up created directory
-            shutil.rmtree(repo_dir)
+        except subprocess.CalledProcessError as e:
+            # Commands run without capturing output have none to report
+            output = e.output
+            if output is None:
+                output = "%s exited with %s" % (' '.join(e.cmd),
+                                                e.returncode)
+            msg = "Could not send to upstream:\n%s" % output
+            ssh.exec_once('gerrit review -m %s %s'
+                          % (pipes.quote(msg), self.revision))
+            logger.error("Change %s: Unable to send to upstream"
+                         % self.change_id)
+            logger.error("Change %s: %s" % (self.change_id, output))
+
+        except Exception:
+            msg = 'Could not send to upstream: Error running git'
+            ssh.exec_once('gerrit review -m %s %s'
+                          % (pipes.quote(msg), self.revision))
+            logger.exception("Change %s: Unable to send to upstream"
+                             % self.change_id)
 
 
 class Group(object):
@@ -836,13 +1910,15 @@ class Group(object):
         retcode, __ = ssh.exec_once(self.get_ls())
         return True if not retcode else False
 
-    def present(self, remote):
+    def present(self, remote, directory=None):
         """
         Makes sure this group is present on gerrit. First checks to see
         if this group exists. If it does not exist already, then this method
         will attempt to create it.
 
         @param remote - gerrit.Remote object
+        @param directory - gerrit.GroupDirectory or None. Existence is
+            checked against the directory instead of asking gerrit.
         @return True if the group exists or was created, False otherwise.
 
         """
@@ -852,8 +1928,13 @@ class Group(object):
 
         ssh = remote.SSH()
 
+        if directory is not None:
+            exists = directory.has(self.name)
+        else:
+            exists = self.exists(ssh)
+
         # If the group already exists, do nothing.
-        if self.exists(ssh):
+        if exists:
             msg = "Group %s: Already exists." % self.name
             logger.info(msg)
             print msg
@@ -865,6 +1946,7 @@ class Group(object):
             msg = "Group %s: Created" % self.name
             logger.info(msg)
             print msg
+            invalidate_group_directory(remote)
         return True if not retcode else False
 
 
@@ -1130,6 +2212,17 @@ class Project(object):
         """
         return self._data.get('upstream', False)
 
+    @property
+    def atomic(self):
+        """
+        Returns whether or not pushes to gerrit should be atomic.
+        Default is non atomic pushes.
+
+        @returns Boolean
+
+        """
+        return self._data.get('atomic', False)
+
     def _create(self, ssh):
         """
         Attempts to create a project through gerrit ssh commands.
@@ -1145,6 +2238,11 @@ class Project(object):
         """
         Builds the groups file and project.config file for a project.
 
+        The blob id of the local project.config and the commit id of the
+        remote refs/meta/config are compared with what was recorded after
+        the last check. refs/meta/config is only fetched when either has
+        changed.
+
         @param remote - gerrit.Remote object
         @param conf - Dict containing git config information
         @param groups - List of groups
@@ -1154,8 +2252,30 @@ class Project(object):
             return
 
         msg = "Project %s: Configuring." % self.name
-        logger.info(msg)
-        print msg
+        log.report(msg, logging.INFO)
+
+        # Get blob id of new config
+        with open(self.config, 'r') as f:
+            contents = f.read()
+        new_blob = git.blob_id(contents)
+
+        ssh_url = 'ssh://%s@%s:%s/%s' % (
+            remote.username,
+            remote.host,
+            remote.port,
+            self.name
+        )
+
+        # Cheap check against what was last seen on gerrit
+        store = state.get_state_store(conf)
+        with remote.session():
+            remote_refs = git.ls_remote(ssh_url, patterns='refs/meta/config')
+        remote_commit = remote_refs.get('refs/meta/config')
+        if remote_commit and \
+                store.meta_config(self.name) == (remote_commit, new_blob):
+            msg = "Project %s: config unchanged." % self.name
+            log.report(msg, logging.INFO)
+            return
 
         repo_dir = '~/tmp'
         repo_dir = os.path.expanduser(repo_dir)
@@ -1170,64 +2290,45 @@ class Project(object):
         )
         os.makedirs(repo_dir)
 
-        # Save the current working directory
-        old_cwd = os.getcwd()
-
         origin = 'origin'
 
         try:
-            # Change cwd to that repo
-            os.chdir(repo_dir)
-
             # Git init empty directory
-            git.init()
-
-            # Add remote origin
-            ssh_url = 'ssh://%s@%s:%s/%s' % (
-                remote.username,
-                remote.host,
-                remote.port,
-                self.name
-            )
+            git.init(cwd=repo_dir)
 
-            git.add_remote(origin, ssh_url)
+            git.add_remote(origin, ssh_url, cwd=repo_dir)
 
             # Fetch refs/meta/config for project
             refspec = 'refs/meta/config:refs/remotes/origin/meta/config'
-            git.fetch(origin, refspec)
+            with remote.session():
+                git.fetch(origin, refspec, cwd=repo_dir)
 
             # Checkout refs/meta/config
-            git.checkout_branch('meta/config')
+            git.checkout_branch('meta/config', cwd=repo_dir)
+            fetched_commit = git.rev_parse('HEAD', cwd=repo_dir)
 
-            # Get md5 of existing config
+            # Get blob id of existing config
             _file = os.path.join(repo_dir, 'project.config')
-            contents = ''
+            existing = ''
             try:
                 with open(_file, 'r') as f:
-                    contents = f.read()
+                    existing = f.read()
             except IOError:
                 pass
-            existing_md5 = hashlib.md5(contents).hexdigest()
+            existing_blob = git.blob_id(existing)
 
-            # Get md5 of new config
-            with open(self.config, 'r') as f:
-                contents = f.read()
-            new_md5 = hashlib.md5(contents).hexdigest()
+            msg = "Project %s: Blob comparision %s %s"
+            msg = msg % (self.name, existing_blob, new_blob)
+            log.report(msg, logging.DEBUG)
 
-            msg = "Project %s: Md5 comparision\n%s\n%s"
-            msg = msg % (self.name, existing_md5, new_md5)
-            logger.debug(msg)
-            print msg
-
-            # Only alter if checksums do not match
-            if existing_md5 != new_md5:
+            # Only alter if blobs do not match
+            if existing_blob != new_blob:
 
                 logger.debug(
-                    "Project %s: config md5's are different." % self.name
+                    "Project %s: config blobs are different." % self.name
                 )
 
                 # Update project.config file
-                _file = os.path.join(repo_dir, 'project.config')
                 with open(_file, 'w') as f:
                     f.write(contents)
 
@@ -1238,30 +2339,33 @@ class Project(object):
                     f.write(group_contents)
 
                 # Git config user.email
-                git.set_config('user.email', conf['git-config']['email'])
+                git.set_config('user.email', conf['git-config']['email'],
+                               cwd=repo_dir)
 
                 # Git config user.name
-                git.set_config('user.name', conf['git-config']['name'])
+                git.set_config('user.name', conf['git-config']['name'],
+                               cwd=repo_dir)
 
                 # Add groups and project.config
-                git.add(['groups', 'project.config'])
+                git.add(['groups', 'project.config'], cwd=repo_dir)
 
                 # Git commit
-                git.commit(message='Setting up %s' % self.name)
+                git.commit(message='Setting up %s' % self.name, cwd=repo_dir)
 
                 # Git push
-                git.push(origin, refspecs='meta/config:refs/meta/config')
+                with remote.session():
+                    git.push(origin, refspecs='meta/config:refs/meta/config',
+                             cwd=repo_dir)
                 logger.info("Project %s: pushed configuration." % self.name)
+                pushed_commit = git.rev_parse('HEAD', cwd=repo_dir)
+                store.set_meta_config(self.name, pushed_commit, new_blob)
 
             else:
                 msg = "Project %s: config unchanged." % self.name
-                logger.info(msg)
-                print msg
+                log.report(msg, logging.INFO)
+                store.set_meta_config(self.name, fetched_commit, new_blob)
 
         finally:
-            # Change to old current working directory
-            os.chdir(old_cwd)
-
             # Attempt to clean up created directory
             shutil.rmtree(repo_dir)
 
@@ -1279,11 +2383,70 @@ class Project(object):
             kwargs['tags'] = True
         return kwargs
 
-    def _sync(self, remote):
+    def is_preserved(self, ref):
+        """
+        Returns whether or not a ref is protected from pruning by
+        preserve_prefix.
+
+        @param ref - String full ref name
+        @returns - Boolean
+
+        """
+        if not self.preserve_prefix:
+            return False
+        heads_prefix = "refs/heads/%s" % self.preserve_prefix
+        tags_prefix = "refs/tags/%s" % self.preserve_prefix
+        return ref.startswith(heads_prefix) or ref.startswith(tags_prefix)
+
+    def ref_diff(self, source_refs, gerrit_refs):
+        """
+        Works out which refs differ between the source repo and gerrit.
+
+        @param source_refs - Dictionary of hashes keyed by ref name
+        @param gerrit_refs - Dictionary of hashes keyed by ref name
+        @returns - Two tuple of sorted lists. Refs to create or update on
+            gerrit and refs to remove from gerrit.
+
+        """
+        updates = sorted(ref for ref, hash_ in source_refs.iteritems()
+                         if gerrit_refs.get(ref) != hash_)
+        prunes = sorted(ref for ref in gerrit_refs
+                        if ref not in source_refs
+                        and not self.is_preserved(ref))
+        return updates, prunes
+
+    def refspecs(self, updates, prunes):
+        """
+        Builds the refspecs for a single push that creates or updates refs
+        and removes pruned refs.
+
+        @param updates - List of ref names to create or update
+        @param prunes - List of ref names to remove
+        @returns - List of String refspecs
+
+        """
+        prefix = '+' if self.force else ''
+        refspecs = ['%s%s:%s' % (prefix, ref, ref) for ref in updates]
+        refspecs += [':%s' % ref for ref in prunes]
+        return refspecs
+
+    def _sync(self, remote, mirrors, store, trust_state=False):
         """
         Pushes all normal branches from a source repo to gerrit.
+        With trust_state, nothing is done when the source refs are the same
+        as at the last recorded sync. Otherwise the ref advertisements of
+        the source and gerrit are compared and nothing is fetched or pushed
+        when they already match. Updates, creations and deletions are sent
+        in one push, split into chunks of PUSH_CHUNK_SIZE refspecs.
+        The source repo is read from a persistent mirror that is updated
+        incrementally instead of being cloned for every sync.
 
         @param remote - gerrit.Remote object
+        @param mirrors - mirror.MirrorCache object
+        @param store - state.StateStore object
+        @param trust_state - Boolean skip comparing with gerrit when the
+            source has not moved. Changes made directly on gerrit are not
+            noticed.
 
         """
         # Only sync if source repo is provided.
@@ -1295,96 +2458,54 @@ class Project(object):
             return
 
         msg = "Project %s: syncing with repo %s." % (self.name, self.source)
-        logger.info(msg)
-        print msg
-
-        repo_dir = '~/tmp'
-        repo_dir = os.path.expanduser(repo_dir)
-        repo_dir = os.path.abspath(repo_dir)
-
-        # Make Empty directory - We want this to stop and fail on OSError
-        if not os.path.isdir(repo_dir):
-            os.makedirs(repo_dir)
-            logger.debug(
-                "Project %s: Created directory %s" % (self.name, repo_dir)
-            )
-
-        # Save the current working directory
-        old_cwd = os.getcwd()
-
-        try:
-            # Change cwd to that repo
-            os.chdir(repo_dir)
+        log.report(msg, logging.INFO)
 
-            uuid_dir = str(uuid4())
-            repo_dir = os.path.join(repo_dir, uuid_dir)
-
-            # Do a git clone --bare <source_repo>
-            git.clone(self.source, name=uuid_dir, bare=True)
+        ssh_url = 'ssh://%s@%s:%s/%s' % (
+            remote.username,
+            remote.host,
+            remote.port,
+            self.name
+        )
 
-            # Change to bare cloned directory
-            os.chdir(uuid_dir)
+        ref_kwargs = self.ref_kwargs()
 
-            # Add remote named gerrit
-            ssh_url = 'ssh://%s@%s:%s/%s' % (
-                remote.username,
-                remote.host,
-                remote.port,
-                self.name
-            )
-            git.add_remote('gerrit', ssh_url)
-
-            # Push heads
-            if self.heads:
-                kwargs = {'all_': True}
-                if self.force:
-                    kwargs['force'] = True
-                git.push('gerrit', **kwargs)
-
-            # Push tags
-            if self.tags:
-                kwargs = {'tags': True}
-                if self.force:
-                    kwargs['force'] = True
-                git.push('gerrit', **kwargs)
-
-            ref_kwargs = self.ref_kwargs()
-
-            # Grab origin refs
-            origin_refset = git.remote_refs('origin', **ref_kwargs)
-
-            # Grab gerrit refs
-            gerrit_refset = git.remote_refs('gerrit', **ref_kwargs)
-
-            # Find refs that should be removed.
-            prune_refset = gerrit_refset - origin_refset
-            if self.preserve_prefix:
-                msg = "Project %s: Preserving refs with prefixes of %s" \
-                      % (self.name, self.preserve_prefix)
-                logger.debug(msg)
-                print msg
-                heads_prefix = "refs/heads/%s" % self.preserve_prefix
-                tags_prefix = "refs/tags/%s" % self.preserve_prefix
-                keep = lambda ref: not ref.startswith(heads_prefix) and \
-                    not ref.startswith(tags_prefix)
-                prune_refset = filter(keep, prune_refset)
-
-            # Prefix each ref in refset with ':' to delete
-            colonize = lambda ref: ':%s' % ref
-            prune_refset = map(colonize, prune_refset)
-
-            # Remove branches no longer needed
-            if prune_refset:
-                git.push('gerrit', refspecs=prune_refset)
+        # Compare source and gerrit refs before touching the mirror
+        source_refs = git.ls_remote(self.source, **ref_kwargs)
+        if trust_state and store.source_refs(self.name) == source_refs:
+            msg = "Project %s: source unchanged since last sync." % self.name
+            log.report(msg, logging.INFO)
+            return
 
-        finally:
-            # Change to old current working directory
-            os.chdir(old_cwd)
+        with remote.session():
+            gerrit_refs = git.ls_remote(ssh_url, **ref_kwargs)
+        updates, prunes = self.ref_diff(source_refs, gerrit_refs)
 
-            # Attempt to clean up created directory
-            shutil.rmtree(repo_dir)
+        if not updates and not prunes:
+            msg = "Project %s: already in sync." % self.name
+            log.report(msg, logging.INFO)
+            store.set_source_refs(self.name, source_refs)
+            return
 
-    def ensure(self, remote, conf):
+        logger.debug("Project %s: refs to update: %s"
+                     % (self.name, ', '.join(updates)))
+        logger.debug("Project %s: refs to prune: %s"
+                     % (self.name, ', '.join(prunes)))
+        if self.preserve_prefix:
+            msg = "Project %s: Preserving refs with prefixes of %s" \
+                  % (self.name, self.preserve_prefix)
+            log.report(msg, logging.DEBUG)
+
+        refspecs = self.refspecs(updates, prunes)
+        with mirrors.lease(self.source) as repo_dir:
+            # Push updates, creations and deletions together
+            for i in range(0, len(refspecs), PUSH_CHUNK_SIZE):
+                chunk = refspecs[i:i + PUSH_CHUNK_SIZE]
+                with remote.session():
+                    git.push(ssh_url, refspecs=chunk, atomic=self.atomic,
+                             cwd=repo_dir)
+        store.set_source_refs(self.name, source_refs)
+
+    def ensure(self, remote, conf, groups=None, trust_state=False):
         """
         Ensures this project is present on gerrit.
         Can optionally create the project if it does not exits.
@@ -1393,16 +2514,21 @@ class Project(object):
 
         @param remote - gerrit.Remote object
         @param conf - Configuration dictionary
+        @param groups - gerrit.GroupDirectory or None to use the cached
+            directory for the remote.
+        @param trust_state - Boolean skip syncing when the source has not
+            moved since the last recorded sync.
 
         """
         msg = "Project %s: Ensuring present." % self.name
-        logger.info(msg)
-        print msg
+        log.report(msg, logging.INFO)
 
         ssh = remote.SSH()
 
         # Get list of groups for building groups file
-        groups = get_groups(remote)
+        if groups is None:
+            groups = get_group_directory(remote,
+                                         ttl=conf['daemon']['group_ttl'])
 
         # Create Project if needed
         self._create(ssh)
@@ -1411,7 +2537,8 @@ class Project(object):
         self._config(remote, conf, groups)
 
         # Sync with source repo if needed
-        self._sync(remote)
+        self._sync(remote, mirror.get_mirror_cache(conf),
+                   state.get_state_store(conf), trust_state=trust_state)
 
 
 def get_groups(remote):
@@ -1431,8 +2558,7 @@ def get_groups(remote):
     retcode, out = ssh.exec_once(cmd)
     if retcode != 0:
         msg = "Unable to retrieve list of gerrit groups."
-        logger.error(msg)
-        print msg
+        log.report(msg, logging.ERROR)
         return groups
 
     # Send to buffer to easy read one line at a time
@@ -1456,12 +2582,108 @@ def get_groups(remote):
     return groups
 
 
+class GroupDirectory(object):
+    """
+    Snapshot of the groups on a gerrit. Lets callers look groups up by
+    name without another ssh command.
+
+    """
+    def __init__(self, groups):
+        """
+        Inits the directory.
+
+        @param groups - List of gerrit.Group objects
+
+        """
+        self._groups = list(groups)
+        self._by_name = dict((g.name, g) for g in self._groups)
+        self.created = time.time()
+
+    def has(self, name):
+        """
+        Returns whether or not a group exists.
+
+        @param name - String group name
+        @returns - Boolean
+
+        """
+        return name in self._by_name
+
+    def get(self, name):
+        """
+        Returns a group by name.
+
+        @param name - String group name
+        @returns - gerrit.Group | None
+
+        """
+        return self._by_name.get(name)
+
+    def __iter__(self):
+        """
+        Iterate over the groups
+
+        @yields - gerrit.Group
+
+        """
+        return iter(self._groups)
+
+    def __len__(self):
+        """
+        Returns the number of groups.
+
+        @returns - Integer
+
+        """
+        return len(self._groups)
+
+
+_directories = {}
+_directories_lock = threading.Lock()
+
+
+def get_group_directory(remote, ttl=0):
+    """
+    Returns the group directory for a remote. A directory fetched less than
+    ttl seconds ago is reused instead of asking gerrit again. An empty
+    group list means the fetch failed and is never cached.
+
+    @param remote - gerrit.Remote object
+    @param ttl - Number of seconds a directory may be reused
+    @returns - gerrit.GroupDirectory
+
+    """
+    key = (remote.host, int(remote.port))
+    with _directories_lock:
+        directory = _directories.get(key)
+        if directory is not None and time.time() - directory.created < ttl:
+            return directory
+
+        directory = GroupDirectory(get_groups(remote))
+        if len(directory):
+            _directories[key] = directory
+        return directory
+
+
+def invalidate_group_directory(remote):
+    """
+    Forgets the cached group directory for a remote. Should be called after
+    groups are created.
+
+    @param remote - gerrit.Remote object
+
+    """
+    key = (remote.host, int(remote.port))
+    with _directories_lock:
+        _directories.pop(key, None)
+
+
 def groups_file_contents(groups):
     """
     Creates the contents of a groups file to be saved with a project's
     configuration.
 
-    @param groups - List of gerrit.Group objects
+    @param groups - Iterable of gerrit.Group objects
     @return String
 
     """
@@ -1473,44 +2695,70 @@ def groups_file_contents(groups):
 
 def get_labels_for_upstream(conf, project_name):
     """
-    Creates dictionary of label objects loaded from the config dictionary.
+    Creates dictionary of label objects loaded from the config.
 
-    @param conf - Dictionary configuration
+    @param conf - config.Config
     @param project_name - String name of a project
     @returns Dictionary of labels keyed by name
 
     """
-    label_dicts = None
-
-    # Look for project specific upstream labels.
-    project_dicts = conf.get('projects', [])
-    for project_dict in project_dicts:
-        if project_dict.get('name') == project_name:
-            label_dicts = project_dict.get('upstream-labels', None)
-            break
-
-    if label_dicts is None:
-        label_dicts = conf.get('upstream-labels', [])
-
     label_objs = {}
-    for l in label_dicts:
-        label = Label(l['name'], int(l['min']), int(l['max']))
+    for name, min_, max_ in conf.label_specs(project_name):
+        label = Label(name, min_, max_)
         label_objs.update({
-            l['name']: label
+            name: label
         })
         logger.debug("Adding label %s with min %s and max %s"
                      % (label.name, label._min, label._max))
     return label_objs
 
 
-def get_review_env():
+_gates = {}
+
+
+def get_label_gate(conf, project_name):
     """
-    Returns an environment to send to subprocess.Popen when using
-    git review.
+    Returns the precompiled label gate for a project. Gates are shared
+    between projects with the same label specs.
+
+    @param conf - config.Config
+    @param project_name - String name of a project
+    @returns - gerrit.LabelGate
+
+    """
+    specs = conf.label_specs(project_name)
+    gate = _gates.get(specs)
+    if gate is None:
+        gate = LabelGate(specs)
+        _gates[specs] = gate
+    return gate
+
+
+def parse_change_url(output, subject=None):
+    """
+    Returns the url of the change gerrit reports when a change is pushed
+    for review. Gerrit lists a line per change it created or updated,
+    parents first, followed by the change's subject. When several are
+    listed, the one whose subject matches is used.
+
+    @param output - String output of git push
+    @param subject - String subject of the pushed change or None
+    @returns - String url | None if no single url belongs to the change
 
-    @returns - Env
     """
-    env = os.environ.copy()
-    env['PATH'] = env.get('PATH', '') + ':/usr/local/bin/'
-    logger.debug("PAth: %s" % env['PATH'])
-    return env
+    matches = CHANGE_URL_RE.findall(output)
+    if len(matches) == 1:
+        return matches[0][0]
+    if subject:
+        subject = subject.strip()
+        urls = []
+        for url, text in matches:
+            # Drop a trailing status like [NEW] and any truncation marker
+            text = re.sub(r'\s*\[[A-Z ]+\]$', '', text.strip())
+            text = text.rstrip('.').strip()
+            if text and (subject.startswith(text) or
+                         text.startswith(subject)):
+                urls.append(url)
+        if len(urls) == 1:
+            return urls[0]
+    return None
@@ -3,7 +3,13 @@ Simple, quick module that wraps subprocess around several common git cli
 command. Should look into swapping out subprocess for one of the already
 existing python/git libraries.
 
+Every command takes a cwd argument naming the repo to run in. Callers
+should always pass it rather than changing the process working directory,
+which is shared by every thread.
+
 """
+import hashlib
+import os
 import subprocess
 import log
 
@@ -24,17 +30,36 @@ class Ref(object):
         return "\t".join([self.hash, self.name])
 
 
-def git_cmd(args):
+def git_cmd(args, cwd=None):
     """
     Convenience method to bundle logged git commands with execution of said
     igt commands.
 
     @param args - List or String reprsenting command to send to subprocess
+    @param cwd - String path of the repo to run in. Defaults to the current
+        working directory.
+
+    """
+    msg = " ". join(args)
+    logger.debug(msg)
+    subprocess.check_call(args, cwd=cwd)
+
+
+def git_output(args, cwd=None):
+    """
+    Like git_cmd but returns what the command wrote. stderr is included
+    since that is where git reports progress and remote messages.
+
+    @param args - List reprsenting command to send to subprocess
+    @param cwd - String path of the repo to run in. Defaults to the current
+        working directory.
+    @returns - String output
+    @raises - subprocess.CalledProcessError with the output on failure
 
     """
     msg = " ". join(args)
     logger.debug(msg)
-    subprocess.check_call(args)
+    return subprocess.check_output(args, stderr=subprocess.STDOUT, cwd=cwd)
 
 
 def listify(thing):
@@ -51,16 +76,18 @@ def listify(thing):
     return thing
 
 
-def init():
+def init(cwd=None):
     """
-    Equivalent to calling git init. Affects current working directory.
+    Equivalent to calling git init.
+
+    @param cwd - String path of the directory to init
 
     """
     args = ['git', 'init']
-    git_cmd(args)
+    git_cmd(args, cwd=cwd)
 
 
-def add_remote(name, url):
+def add_remote(name, url, cwd=None):
     """
     git remote add
     Adds a remote to the git repo that should be the current working
@@ -70,66 +97,100 @@ def add_remote(name, url):
 
     @param name = String name of the remote to add
     @param url = String url of the remote repo
+    @param cwd - String path of the repo
 
     """
     args = ['git', 'remote', 'add', name, url]
-    git_cmd(args)
+    git_cmd(args, cwd=cwd)
     logger.debug("Added remote %s: %s" % (name, url))
 
 
-def fetch(remote, refspecs):
+def fetch(remote, refspecs=None, prune=False, cwd=None):
     """
     git fetch
-    Fetches a list respecs from the specified remote.
+    Fetches a list respecs from the specified remote. The remote's
+    configured refspecs are used if no refspecs are given.
 
     Equivalent to:
-        git fetch <remote> <refspec[0]> <refspec[1]> ... <refspec[n]>
+        git fetch [--prune] <remote> <refspec[0]> <refspec[1]> ... <refspec[n]>
 
     @param remote - String name of the remote
     @param refspecs - List of strings that are refspecs
+    @param prune - Boolean remove refs that no longer exist on the remote
+    @param cwd - String path of the repo
 
     """
-    refspecs = listify(refspecs)
     args = ['git', 'fetch', remote]
-    args = args + refspecs
-    git_cmd(args)
+    if prune:
+        args.insert(2, '--prune')
+    if refspecs:
+        args = args + listify(refspecs)
+    git_cmd(args, cwd=cwd)
 
 
-def checkout_branch(name, new=False):
+def checkout_branch(name, new=False, start=None, force=False, cwd=None):
     """
     git checkout
-    Checks out a branch. Optionally creates a new branch
+    Checks out a branch. Optionally creates a new branch. A forced
+    checkout throws away local changes and resets the new branch if it
+    already exists.
 
     Equivalent to:
-        git checkout [-b] <name>
+        git checkout [-f] [-b|-B] <name> [<start>]
 
     @param name - String name of branch
     @param new - Boolean create a new branch
+    @param start - String commit the new branch should start at
+    @param force - Boolean discard local changes
+    @param cwd - String path of the repo
 
     """
     args = ['git', 'checkout', name]
     if new:
-        args.insert(2, '-b')
-    git_cmd(args)
+        args.insert(2, '-B' if force else '-b')
+        if start:
+            args.append(start)
+    if force:
+        args.insert(2, '-f')
+    git_cmd(args, cwd=cwd)
 
 
-def set_config(name, value):
+def clean(cwd=None):
+    """
+    git clean
+    Removes untracked and ignored files from the work tree.
+
+    Equivalent to:
+        git clean -fdx --quiet
+
+    @param cwd - String path of the repo
+
+    """
+    args = ['git', 'clean', '-fdx', '--quiet']
+    git_cmd(args, cwd=cwd)
+
+
+def set_config(name, value, add=False, cwd=None):
     """
     git config
     Sets a git configuration key value pair for the current directory repo
 
     Equivalent to:
-        git config <name> <value>
+        git config [--add] <name> <value>
 
     @param name - String name of value to set
     @param value - String value
+    @param add - Boolean add another value instead of replacing
+    @param cwd - String path of the repo
 
     """
     args = ['git', 'config', name, value]
-    git_cmd(args)
+    if add:
+        args.insert(2, '--add')
+    git_cmd(args, cwd=cwd)
 
 
-def add(things):
+def add(things, cwd=None):
     """
     git add
     Adds multiple things to staging
@@ -138,16 +199,17 @@ def add(things):
         git add <things[0]> <things[1]> ... <things[2]>
 
     @param things - List of paths to add
+    @param cwd - String path of the repo
 
     """
     things = listify(things)
     if isinstance(things, str):
         things = listify(things)
     args = ['git', 'add'] + things
-    git_cmd(args)
+    git_cmd(args, cwd=cwd)
 
 
-def commit(message=''):
+def commit(message='', cwd=None):
     """
     git commit
     Commits the staged changes on the current repo
@@ -155,23 +217,30 @@ def commit(message=''):
     Equivalent to:
         git commit -m message
 
+    @param message - String commit message
+    @param cwd - String path of the repo
+
     """
     args = ['git', 'commit', '-m', message]
-    git_cmd(args)
+    git_cmd(args, cwd=cwd)
 
 
-def push(remote, all_=False, tags=False, force=False, refspecs=None):
+def push(remote, all_=False, tags=False, force=False, refspecs=None,
+         atomic=False, cwd=None):
     """
     git push
 
     Equivalent to:
-        git push <remote> [--all] [--tags] \
+        git push <remote> [--all] [--tags] [--force] [--atomic] \
         [<refspecs[0]> <refspecs[1]> ... <refspecs[n]>]
 
-    @param remote - String name of remote to push to
+    @param remote - String name or url of remote to push to
     @param all_ - Boolean push all HEAD branches
     @param tags - Boolean push all tags
+    @param force - Boolean force updates
     @param refspecs - List of refspecs to push
+    @param atomic - Boolean all refs update or none do
+    @param cwd - String path of the repo
 
     """
     args = ['git', 'push', remote]
@@ -181,13 +250,76 @@ def push(remote, all_=False, tags=False, force=False, refspecs=None):
         args.append('--tags')
     if force:
         args.append('--force')
+    if atomic:
+        args.append('--atomic')
     if refspecs:
         refspecs = listify(refspecs)
         args = args + refspecs
-    git_cmd(args)
+    git_cmd(args, cwd=cwd)
+
+
+def push_for_review(remote, branch, topic=None, cwd=None):
+    """
+    git push to gerrit
+    Pushes HEAD as a change for review on branch.
+
+    Equivalent to:
+        git push <remote> HEAD:refs/for/<branch>[%topic=<topic>]
+
+    @param remote - String name or url of remote to push to
+    @param branch - String target branch of the change
+    @param topic - String topic of the change
+    @param cwd - String path of the repo
+    @returns - String output of the push, including remote messages
+
+    """
+    ref = 'HEAD:refs/for/%s' % branch
+    if topic:
+        ref = '%s%%topic=%s' % (ref, topic)
+    args = ['git', 'push', remote, ref]
+    return git_output(args, cwd=cwd)
 
 
-def clone(source, name=None, bare=False):
+def set_alternates(paths, cwd=None):
+    """
+    Sets the object directories a repo may borrow objects from by writing
+    .git/objects/info/alternates. An empty list removes the alternates.
+
+    @param paths - List of String paths of objects directories
+    @param cwd - String path of a non bare repo
+
+    """
+    alternates = os.path.join(cwd or '.', '.git', 'objects', 'info',
+                              'alternates')
+    if not paths:
+        if os.path.exists(alternates):
+            os.remove(alternates)
+        return
+    directory = os.path.dirname(alternates)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(alternates, 'w') as f:
+        f.write(''.join('%s\n' % path for path in paths))
+
+
+def get_alternates(cwd=None):
+    """
+    Returns the object directories a non bare repo borrows objects from.
+
+    @param cwd - String path of a non bare repo
+    @returns - List of String paths
+
+    """
+    alternates = os.path.join(cwd or '.', '.git', 'objects', 'info',
+                              'alternates')
+    try:
+        with open(alternates, 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+    except IOError:
+        return []
+
+
+def clone(source, name=None, bare=False, cwd=None):
     """
     git clone
     Clones a repo
@@ -198,6 +330,7 @@ def clone(source, name=None, bare=False):
     @param source - Url to source repo
     @param name - String name of directory to clone into
     @param bare - Boolean clone with the --bare option
+    @param cwd - String path of the directory to clone from
 
     """
     args = ['git', 'clone', source]
@@ -205,10 +338,48 @@ def clone(source, name=None, bare=False):
         args.append(name)
     if bare:
         args.insert(2, '--bare')
-    git_cmd(args)
+    git_cmd(args, cwd=cwd)
 
 
-def remote_refs(remote, heads=False, tags=False):
+def gc(bitmaps=False, prune=True, cwd=None):
+    """
+    git gc
+    Repacks and cleans up a repo. Optionally writes reachability bitmaps.
+    Without prune, unreachable objects are kept, which repos borrowing
+    objects through alternates may still need.
+
+    Equivalent to:
+        git [-c repack.writeBitmaps=true] [-c gc.pruneExpire=never] gc --quiet
+
+    @param bitmaps - Boolean write reachability bitmaps
+    @param prune - Boolean remove old unreachable objects
+    @param cwd - String path of the repo
+
+    """
+    args = ['git', 'gc', '--quiet']
+    if not prune:
+        args[1:1] = ['-c', 'gc.pruneExpire=never']
+    if bitmaps:
+        args[1:1] = ['-c', 'repack.writeBitmaps=true']
+    git_cmd(args, cwd=cwd)
+
+
+def write_commit_graph(cwd=None):
+    """
+    git commit-graph
+    Writes a commit-graph file for all reachable commits.
+
+    Equivalent to:
+        git commit-graph write --reachable
+
+    @param cwd - String path of the repo
+
+    """
+    args = ['git', 'commit-graph', 'write', '--reachable']
+    git_cmd(args, cwd=cwd)
+
+
+def remote_refs(remote, heads=False, tags=False, cwd=None):
     """
     git ls-remote
     Parses the output of git ls-remote
@@ -219,6 +390,7 @@ def remote_refs(remote, heads=False, tags=False):
     @param remote - String remote name
     @param heads - Boolean look at all heads
     @param tags - Boolean look at all tags
+    @param cwd - String path of the repo
     @returns - Set of all refs
 
     """
@@ -227,6 +399,95 @@ def remote_refs(remote, heads=False, tags=False):
         args.insert(2, '--heads')
     if tags:
         args.insert(2, '--tags')
-    cmd = subprocess.Popen(args, stdout=subprocess.PIPE)
+    cmd = subprocess.Popen(args, stdout=subprocess.PIPE, cwd=cwd)
     s = lambda line: line.rstrip().split("\t")[1]
-    return set(map(s, cmd.stdout))
+    refs = set(map(s, cmd.stdout))
+    cmd.wait()
+    return refs
+
+
+def ls_remote(remote, heads=False, tags=False, patterns=None, cwd=None):
+    """
+    git ls-remote
+    Parses the output of git ls-remote into a dictionary of ref hashes.
+    Peeled tag entries (refs/tags/<tag>^{}) are left out.
+
+    Equivalent to
+        git ls-remote [--heads] [--tags] <remote> [<patterns>...]
+
+    @param remote - String remote name or url
+    @param heads - Boolean look at all heads
+    @param tags - Boolean look at all tags
+    @param patterns - List of ref patterns to limit the output to
+    @param cwd - String path of the repo
+    @returns - Dictionary of String hashes keyed by ref name
+
+    """
+    args = ['git', 'ls-remote', remote]
+    if heads:
+        args.insert(2, '--heads')
+    if tags:
+        args.insert(2, '--tags')
+    if patterns:
+        args = args + listify(patterns)
+    logger.debug(" ".join(args))
+    out = subprocess.check_output(args, cwd=cwd)
+    refs = {}
+    for line in out.splitlines():
+        hash_, name = line.rstrip().split("\t", 1)
+        if not name.endswith('^{}'):
+            refs[name] = hash_
+    return refs
+
+
+def rev_parse(rev, cwd=None):
+    """
+    git rev-parse
+    Resolves a revision to an object id.
+
+    Equivalent to:
+        git rev-parse <rev>
+
+    @param rev - String revision
+    @param cwd - String path of the repo
+    @returns - String object id
+
+    """
+    args = ['git', 'rev-parse', rev]
+    logger.debug(" ".join(args))
+    return subprocess.check_output(args, cwd=cwd).strip()
+
+
+def git_dir(cwd=None):
+    """
+    git rev-parse --git-dir
+    Returns the git directory of a repo, or None if cwd is not a working
+    repo.
+
+    @param cwd - String path of the repo
+    @returns - String absolute path | None
+
+    """
+    args = ['git', 'rev-parse', '--git-dir']
+    logger.debug(" ".join(args))
+    try:
+        with open(os.devnull, 'w') as devnull:
+            out = subprocess.check_output(args, stderr=devnull, cwd=cwd)
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    return os.path.abspath(os.path.join(cwd or '.', out.strip()))
+
+
+def blob_id(contents):
+    """
+    Computes the git blob id of some file contents without running git.
+
+    Equivalent to:
+        git hash-object <file>
+
+    @param contents - String file contents
+    @returns - String blob id
+
+    """
+    header = 'blob %d\0' % len(contents)
+    return hashlib.sha1(header + contents).hexdigest()
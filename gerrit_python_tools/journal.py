@@ -0,0 +1,356 @@
+"""
+Durable journal of stream events. Stream readers append every event they
+dispatch and workers commit an event once the work it caused is finished.
+After a restart the events that were never committed are replayed.
+
+The journal is a directory of append only segment files named after the
+sequence number of their first record. Each record is a line of
+<seq>\t<source>\t<raw event>. The commit offset is the highest sequence
+number below which every event is committed. It is kept in its own file
+together with the events committed above it, so finished work is not
+replayed after a restart, and segments wholly below it are removed.
+
+"""
+import log
+import os
+import threading
+from thread import StoppableThread
+
+logger = log.get_logger()
+
+SEGMENT_SUFFIX = '.log'
+
+
+class Journal(object):
+    """
+    Append only, segment rotated event journal with a commit offset.
+    Appends are written immediately but synced to disk in groups by a
+    flusher thread so journaling does not slow down the streams.
+
+    """
+    def __init__(self, directory, segment_size, fsync_interval):
+        """
+        Inits the journal, creating the directory if needed.
+
+        @param directory - String directory to keep segments in
+        @param segment_size - Integer bytes after which a new segment is
+            started
+        @param fsync_interval - Number of seconds between group syncs
+
+        """
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.segment_size = int(segment_size)
+        self.fsync_interval = float(fsync_interval)
+
+        self._lock = threading.Lock()
+        self._offset, self._done = self._read_offset()
+        self._saved_offset = self._offset
+        self._commits_dirty = False
+        self._file = None
+        self._dirty = False
+
+        # Continue numbering after anything already journaled or committed
+        last = max([self._offset] + list(self._done))
+        for _, _, seq, _, _ in self._records():
+            last = max(last, seq)
+        self._next = last + 1
+
+        self._flusher = JournalFlusher(self)
+        self._flusher.start()
+
+    @property
+    def offset(self):
+        """
+        Returns the commit offset.
+
+        @returns - Integer
+
+        """
+        with self._lock:
+            return self._offset
+
+    def _offset_path(self):
+        """
+        Returns the location of the commit offset file.
+
+        @returns - String path
+
+        """
+        return os.path.join(self.directory, 'offset')
+
+    def _read_offset(self):
+        """
+        Reads the commit offset and the events committed above it from
+        disk. The offset is on the first line of the file followed by one
+        committed sequence number per line.
+
+        @returns - Two tuple of Integer offset and Set of Integer sequence
+            numbers. (0, set()) if nothing was committed yet.
+
+        """
+        try:
+            with open(self._offset_path(), 'r') as f:
+                seqs = [int(seq) for seq in f.read().split()]
+        except (IOError, ValueError):
+            return 0, set()
+        if not seqs:
+            return 0, set()
+        return seqs[0], set(s for s in seqs[1:] if s > seqs[0])
+
+    def _segments(self):
+        """
+        Returns the segment files in sequence order.
+
+        @returns - List of (first seq, path) tuples
+
+        """
+        segments = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            try:
+                first = int(name[:-len(SEGMENT_SUFFIX)])
+            except ValueError:
+                continue
+            segments.append((first, os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    def _records(self):
+        """
+        Reads every record in the journal. A torn last line left by a crash
+        is skipped.
+
+        @yields - (first seq, path, seq, source, line) tuples
+
+        """
+        for first, path in self._segments():
+            with open(path, 'r') as f:
+                for record in f:
+                    if not record.endswith('\n'):
+                        continue
+                    try:
+                        seq, source, line = record[:-1].split('\t', 2)
+                        seq = int(seq)
+                    except ValueError:
+                        continue
+                    yield first, path, seq, source, line
+
+    def replay(self):
+        """
+        Returns the records that were never committed.
+
+        @returns - List of (seq, source, line) tuples in sequence order
+
+        """
+        with self._lock:
+            offset = self._offset
+            done = set(self._done)
+        return [(seq, source, line)
+                for _, _, seq, source, line in self._records()
+                if seq > offset and seq not in done]
+
+    def append(self, source, line):
+        """
+        Appends an event to the journal.
+
+        @param source - String name of the stream
+        @param line - String raw JSON event
+        @returns - Integer sequence number of the event
+
+        """
+        line = line.rstrip('\n')
+        with self._lock:
+            seq = self._next
+            self._next += 1
+            if self._file is None or self._file.tell() >= self.segment_size:
+                self._rotate(seq)
+            self._file.write('%d\t%s\t%s\n' % (seq, source, line))
+            self._dirty = True
+        return seq
+
+    def _rotate(self, seq):
+        """
+        Starts a new segment whose first record is seq. Lock must be held.
+
+        @param seq - Integer sequence number
+
+        """
+        if self._file is not None:
+            self._sync_file()
+            self._file.close()
+        path = os.path.join(self.directory,
+                            '%020d%s' % (seq, SEGMENT_SUFFIX))
+        self._file = open(path, 'a')
+        logger.debug("Journal: started segment %s" % path)
+
+    def _sync_file(self):
+        """
+        Flushes and syncs the current segment. Lock must be held.
+
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._dirty = False
+
+    def commit(self, seq):
+        """
+        Marks an event as done. The commit offset advances over every
+        event that is done with no gaps below it.
+
+        @param seq - Integer sequence number
+
+        """
+        with self._lock:
+            if seq <= self._offset:
+                return
+            self._done.add(seq)
+            while self._offset + 1 in self._done:
+                self._offset += 1
+                self._done.remove(self._offset)
+            self._commits_dirty = True
+
+    def flush(self):
+        """
+        Syncs appended records to disk, saves the commit offset and the
+        events committed above it if anything was committed and removes
+        segments that are wholly committed.
+
+        """
+        fd = None
+        done = None
+        with self._lock:
+            if self._dirty:
+                self._file.flush()
+                fd = os.dup(self._file.fileno())
+                self._dirty = False
+            offset = self._offset
+            if self._commits_dirty:
+                done = sorted(self._done)
+                self._commits_dirty = False
+
+        # Sync outside of the lock so appends are not held up
+        if fd is not None:
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        if done is None:
+            return
+        try:
+            self._save_offset(offset, done)
+        except Exception:
+            with self._lock:
+                self._commits_dirty = True
+            raise
+        if offset != self._saved_offset:
+            self._saved_offset = offset
+            self._truncate(offset)
+
+    def _save_offset(self, offset, done):
+        """
+        Writes the commit offset and the events committed above it to disk
+        atomically.
+
+        @param offset - Integer commit offset
+        @param done - List of Integer sequence numbers committed above
+            offset
+
+        """
+        path = self._offset_path()
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as f:
+            f.write(''.join('%d\n' % seq for seq in [offset] + done))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+
+    def _truncate(self, offset):
+        """
+        Removes segments whose records are all at or below offset. The
+        newest segment is always kept.
+
+        @param offset - Integer commit offset
+
+        """
+        segments = self._segments()
+        for (_, path), (next_first, _) in zip(segments, segments[1:]):
+            if next_first - 1 > offset:
+                break
+            logger.debug("Journal: removing segment %s" % path)
+            os.remove(path)
+
+    def close(self):
+        """
+        Syncs everything to disk and closes the current segment.
+
+        """
+        self.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def completes(self, func, seqs):
+        """
+        Wraps func so that seqs are committed once it returns or raises.
+
+        @param func - Function to wrap
+        @param seqs - List of Integer sequence numbers
+        @returns - Function
+
+        """
+        def wrapped(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                for seq in seqs:
+                    self.commit(seq)
+        return wrapped
+
+
+class JournalFlusher(StoppableThread):
+    """
+    Thread that group syncs a journal every fsync interval. Stopping it
+    syncs and closes the journal.
+
+    """
+    def __init__(self, journal):
+        """
+        Inits the flusher.
+
+        @param journal - journal.Journal
+
+        """
+        super(JournalFlusher, self).__init__()
+        self.daemon = True
+        self.journal = journal
+
+    def run(self):
+        """
+        Flushes the journal until stopped.
+
+        """
+        while not self._stop.wait(self.journal.fsync_interval):
+            try:
+                self.journal.flush()
+            except Exception:
+                logger.exception("Journal: unable to flush")
+        self.journal.close()
+
+
+def get_journal(conf):
+    """
+    Returns a Journal described by the journal and cache sections of conf.
+
+    @param conf - Configuration dictionary
+    @returns - journal.Journal
+
+    """
+    return Journal(
+        os.path.join(conf['cache']['dir'], 'journal'),
+        int(conf['journal']['segment_size']) * 1024 * 1024,
+        conf['journal']['fsync_interval']
+    )
@@ -2,6 +2,7 @@ import config
 import logging
 import logging.handlers
 import os
+import sys
 
 DEFAULT_CONFIG = {
     'file': '/var/log/gerrit-python-tools/gerrit-sync',
@@ -32,6 +33,20 @@ def get_logger(name='gerrit-python-tools'):
     """
     return logging.getLogger(name)
 
+
+def report(msg, level=logging.INFO):
+    """
+    Logs and prints a message. The message and its newline are written
+    in a single call so lines from concurrent threads don't interleave.
+
+    @param msg - String message
+    @param level - Integer logging level to log the message at
+
+    """
+    get_logger().log(level, msg)
+    sys.stdout.write("%s\n" % msg)
+
+
 logging_conf_file = '/etc/gerrit-python-tools/logging.yaml'
 logging_conf = config.load_config(logging_conf_file, default=DEFAULT_CONFIG)
 
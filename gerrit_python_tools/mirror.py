@@ -0,0 +1,252 @@
+"""
+Persistent cache of bare mirrors of source repos. Mirrors are keyed by
+source url and kept up to date with incremental fetches instead of being
+cloned from scratch for every sync.
+
+"""
+import fcntl
+import git
+import hashlib
+import log
+import os
+import shutil
+import subprocess
+import time
+from contextlib import contextmanager
+
+logger = log.get_logger()
+
+# Refs kept in a mirror. Other refs such as pull requests are not needed.
+MIRROR_REFSPECS = [
+    '+refs/heads/*:refs/heads/*',
+    '+refs/tags/*:refs/tags/*'
+]
+
+
+def dir_size(path):
+    """
+    Returns the size in bytes of all files under path.
+
+    @param path - String path of a directory
+    @returns - Integer
+
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class MirrorCache(object):
+    """
+    Directory of bare mirrors keyed by source url. Each mirror has a lock
+    file so concurrent syncs of the same source, in this process or in
+    another, take turns. The lock file's modification time records when the
+    mirror was last used and drives LRU eviction.
+
+    """
+    def __init__(self, root, max_size, maintenance_interval):
+        """
+        Inits the cache.
+
+        @param root - String directory to keep mirrors in
+        @param max_size - Integer max total size of mirrors in bytes
+        @param maintenance_interval - Integer seconds between maintenance
+            runs on a mirror
+
+        """
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.max_size = int(max_size)
+        self.maintenance_interval = int(maintenance_interval)
+
+    def path_for(self, source):
+        """
+        Returns the location of the mirror for a source url.
+
+        @param source - String url of the source repo
+        @returns - String path
+
+        """
+        name = hashlib.sha1(source).hexdigest()
+        return os.path.join(self.root, '%s.git' % name)
+
+    @contextmanager
+    def lease(self, source):
+        """
+        Context manager that locks the mirror of source, creates or updates
+        it, and yields its path. Stale mirrors are evicted afterwards.
+
+        @param source - String url of the source repo
+        @yields - String path of an up to date bare mirror
+
+        """
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+        path = self.path_for(source)
+        with open('%s.lock' % path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                os.utime(lock.name, None)
+                self._update(source, path)
+                self._maintain(path)
+                yield path
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.evict(keep=path)
+
+    def _clone(self, source, path):
+        """
+        Creates a new mirror. The clone is made next to its final location
+        and moved into place so a failed clone never leaves a partial mirror.
+
+        @param source - String url of the source repo
+        @param path - String path of the mirror
+
+        """
+        logger.info("Mirror %s: cloning %s" % (path, source))
+        tmp_path = '%s.tmp' % path
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        git.clone(source, name=tmp_path, bare=True)
+        git.set_config('remote.origin.fetch', MIRROR_REFSPECS[0],
+                       cwd=tmp_path)
+        for refspec in MIRROR_REFSPECS[1:]:
+            git.set_config('remote.origin.fetch', refspec, add=True,
+                           cwd=tmp_path)
+        os.rename(tmp_path, path)
+
+    def _update(self, source, path):
+        """
+        Brings a mirror up to date with an incremental fetch, cloning it if
+        it does not exist. A mirror that is no longer a repo is cloned
+        again. Fetch failures, such as the source being unreachable, are
+        raised and the mirror is kept. Lock must be held.
+
+        @param source - String url of the source repo
+        @param path - String path of the mirror
+
+        """
+        if os.path.isdir(path) and git.git_dir(cwd=path) != path:
+            logger.error("Mirror %s: not a repo, recloning" % path)
+            shutil.rmtree(path)
+
+        if not os.path.isdir(path):
+            self._clone(source, path)
+            return
+
+        logger.debug("Mirror %s: fetching %s" % (path, source))
+        git.fetch('origin', prune=True, cwd=path)
+
+    def _maintain(self, path):
+        """
+        Runs gc with bitmaps and writes a commit-graph on a mirror if it
+        has not been done within the maintenance interval. Unreachable
+        objects are never pruned since workspaces borrow objects from the
+        mirror and may still need objects of branches removed from the
+        source. Failures are logged but don't stop the sync. Lock must be
+        held.
+
+        @param path - String path of the mirror
+
+        """
+        stamp = '%s.maintained' % path
+        try:
+            last = os.path.getmtime(stamp)
+        except OSError:
+            last = 0
+        if time.time() - last < self.maintenance_interval:
+            return
+
+        logger.info("Mirror %s: running maintenance" % path)
+        try:
+            git.gc(bitmaps=True, prune=False, cwd=path)
+            git.write_commit_graph(cwd=path)
+        except subprocess.CalledProcessError:
+            logger.exception("Mirror %s: maintenance failed" % path)
+        with open(stamp, 'a'):
+            os.utime(stamp, None)
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used mirrors until the total size of the
+        cache is within max_size. Mirrors that are currently leased are
+        skipped.
+
+        @param keep - String path of a mirror that should not be evicted
+
+        """
+        evict_lru(self.root, self.max_size, keep=keep,
+                  companions=['.maintained'])
+
+
+def evict_lru(root, max_size, keep=None, companions=None):
+    """
+    Removes least recently used directories ending in .git under root until
+    their total size is within max_size. Each directory has a lock file
+    whose modification time records when it was last used. Directories
+    whose lock is held are skipped. Lock files are never removed so that
+    anyone waiting on one still shares it with the next user.
+
+    @param root - String directory holding the cached directories
+    @param max_size - Integer max total size in bytes
+    @param keep - String path of a directory that should not be evicted
+    @param companions - List of String suffixes of files kept next to each
+        directory that should be removed with it
+
+    """
+    entries = []
+    total = 0
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not name.endswith('.git') or not os.path.isdir(path):
+            continue
+        try:
+            used = os.path.getmtime('%s.lock' % path)
+        except OSError:
+            used = 0
+        size = dir_size(path)
+        total += size
+        entries.append((used, path, size))
+
+    entries.sort()
+    for _, path, size in entries:
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        with open('%s.lock' % path, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                continue
+            try:
+                logger.info("Evicting %s: %s bytes" % (path, size))
+                shutil.rmtree(path)
+                for suffix in companions or []:
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+                total -= size
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def get_mirror_cache(conf):
+    """
+    Returns a MirrorCache described by the cache section of conf.
+
+    @param conf - Configuration dictionary
+    @returns - mirror.MirrorCache
+
+    """
+    cache = conf['cache']
+    return MirrorCache(
+        os.path.join(cache['dir'], 'mirrors'),
+        int(cache['mirror_size']) * 1024 * 1024,
+        cache['maintenance_interval']
+    )
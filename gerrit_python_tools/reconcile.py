@@ -0,0 +1,202 @@
+"""
+Reconciles the groups and users in the configuration with gerrit. What
+already exists on gerrit is fetched with a few bulk queries and diffed
+against the configuration in memory so that create commands are only sent
+for what is missing.
+
+"""
+import json
+import log
+
+logger = log.get_logger()
+
+# Lists every account username in one query.
+ACCOUNTS_QUERY = ('gerrit gsql --format JSON -c "SELECT external_id FROM'
+                  ' account_external_ids WHERE external_id LIKE'
+                  ' \'username:%\'"')
+
+
+class Plan(object):
+    """
+    Result of diffing configured entities against gerrit. Entities are
+    either already present or missing. When gerrit could not be asked in
+    bulk the plan is unverified and every entity is treated as missing,
+    letting gerrit reject the ones that exist.
+
+    """
+    def __init__(self, kind, present, missing, verified=True):
+        """
+        Inits the plan.
+
+        @param kind - String kind of entity, such as 'Group' or 'User'
+        @param present - List of String names already on gerrit
+        @param missing - List of (name, entity) tuples to create
+        @param verified - Boolean False if existence could not be checked
+
+        """
+        self.kind = kind
+        self.present = present
+        self.missing = missing
+        self.verified = verified
+
+    def lines(self):
+        """
+        Returns a human readable description of the plan.
+
+        @returns - List of Strings
+
+        """
+        lines = []
+        for name in self.present:
+            lines.append("%s %s: Already exists." % (self.kind, name))
+        action = 'Would create' if self.verified else 'Would try to create'
+        for name, _ in self.missing:
+            lines.append("%s %s: %s." % (self.kind, name, action))
+        lines.append("%s plan: %s present, %s to create."
+                     % (self.kind, len(self.present), len(self.missing)))
+        return lines
+
+
+def creation_waves(groups):
+    """
+    Splits groups that need to be created into waves so that a group is
+    never created in the same wave as, or before, its owning group.
+
+    @param groups - List of gerrit.Group objects
+    @returns - List of lists of gerrit.Group objects
+
+    """
+    waves = []
+    remaining = list(groups)
+    while remaining:
+        pending = set(g.name for g in remaining)
+        wave = [g for g in remaining if g.owner not in pending
+                or g.owner == g.name]
+        # Cyclic owners can not be ordered, send them all and let gerrit
+        # sort it out.
+        if not wave:
+            wave = remaining
+        waves.append(wave)
+        remaining = [g for g in remaining if g not in wave]
+    return waves
+
+
+def get_usernames(remote):
+    """
+    Returns the usernames of every account on gerrit using a single gsql
+    query.
+
+    @param remote - gerrit.Remote object
+    @returns - Set of Strings or None if gerrit could not be queried
+
+    """
+    retcode, out = remote.SSH().exec_once(ACCOUNTS_QUERY)
+    if retcode:
+        logger.warning("Unable to list accounts: %s" % out.strip())
+        return None
+
+    usernames = set()
+    for line in out.splitlines():
+        try:
+            row = json.loads(line)
+        except ValueError:
+            continue
+        if row.get('type') == 'error':
+            logger.warning("Unable to list accounts: %s"
+                           % row.get('message'))
+            return None
+        if row.get('type') != 'row':
+            continue
+        external_id = row.get('columns', {}).get('external_id', '')
+        if external_id.startswith('username:'):
+            usernames.add(external_id[len('username:'):])
+    return usernames
+
+
+def plan_groups(remote, groups, directory):
+    """
+    Diffs configured groups against the group directory. If the directory
+    is empty, each group is looked up instead over a single connection.
+
+    @param remote - gerrit.Remote object
+    @param groups - List of gerrit.Group objects
+    @param directory - gerrit.GroupDirectory
+    @returns - reconcile.Plan
+
+    """
+    if len(directory):
+        exists = [directory.has(g.name) for g in groups]
+    else:
+        results = remote.exec_many([g.get_ls() for g in groups])
+        exists = [not retcode for retcode, __ in results]
+
+    present = []
+    missing = []
+    for group, group_exists in zip(groups, exists):
+        if group_exists:
+            present.append(group.name)
+        else:
+            missing.append((group.name, group))
+    return Plan('Group', present, missing)
+
+
+def plan_users(remote, users):
+    """
+    Diffs configured users against the accounts on gerrit.
+
+    @param remote - gerrit.Remote object
+    @param users - List of gerrit.User objects
+    @returns - reconcile.Plan
+
+    """
+    usernames = get_usernames(remote)
+    if usernames is None:
+        return Plan('User', [], [(u.username, u) for u in users],
+                    verified=False)
+
+    present = []
+    missing = []
+    for user in users:
+        if user.username in usernames:
+            present.append(user.username)
+        else:
+            missing.append((user.username, user))
+    return Plan('User', present, missing)
+
+
+def apply_groups(remote, plan):
+    """
+    Creates the missing groups of a plan. Groups are created concurrently
+    in waves so owning groups exist first.
+
+    @param remote - gerrit.Remote object
+    @param plan - reconcile.Plan
+    @returns - List of (name, retcode, output) tuples
+
+    """
+    results = []
+    for wave in creation_waves([group for _, group in plan.missing]):
+        outputs = remote.exec_many([g.get_create() for g in wave])
+        for group, (retcode, out) in zip(wave, outputs):
+            results.append((group.name, retcode, out))
+    return results
+
+
+def apply_users(remote, plan):
+    """
+    Creates the missing users of a plan concurrently. For unverified plans
+    accounts that already exist are reported with a retcode of None.
+
+    @param remote - gerrit.Remote object
+    @param plan - reconcile.Plan
+    @returns - List of (name, retcode, output) tuples
+
+    """
+    users = [user for _, user in plan.missing]
+    outputs = remote.exec_many([u.get_create() for u in users])
+    results = []
+    for user, (retcode, out) in zip(users, outputs):
+        if not plan.verified and retcode == 1 and 'already exists' in out:
+            retcode = None
+        results.append((user.username, retcode, out))
+    return results
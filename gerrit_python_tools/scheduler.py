@@ -0,0 +1,105 @@
+"""
+Scheduler for tasks that should run later. Tasks are kept in a priority
+heap ordered by due time. Tasks may be keyed so that scheduling a task
+whose key is already pending merges into the pending task instead of
+adding another one. Tasks carry the journal sequence numbers of the events
+that caused them, including those of merged tasks.
+
+"""
+import heapq
+import itertools
+import log
+
+logger = log.get_logger()
+
+
+class Scheduler(object):
+    """
+    Priority heap of delayed tasks with per key coalescing.
+
+    """
+    def __init__(self):
+        """
+        Inits an empty schedule.
+
+        """
+        self._heap = []
+        self._pending = {}
+        self._counter = itertools.count()
+        self.coalesced = 0
+
+    def add(self, due, func, args, kwargs, key=None, seqs=None):
+        """
+        Schedules func(*args, **kwargs) to run at due. If key is not None
+        and a task with the same key is still pending, the new task is
+        merged into the pending task and keeps the pending due time.
+
+        @param due - Float unix time the task should run at
+        @param func - Function to run
+        @param args - List of args to send to function
+        @param kwargs - Dictionary of kwargs to send to function
+        @param key - Hashable key identifying the work or None
+        @param seqs - List of journal sequence numbers the task completes
+        @returns - Boolean True if scheduled, False if merged
+
+        """
+        seqs = list(seqs or [])
+        if key is not None and key in self._pending:
+            self.coalesced += 1
+            self._pending[key][6].extend(seqs)
+            logger.debug("Schedule: merged %s into pending task" % (key,))
+            return False
+
+        entry = (due, next(self._counter), key, func, args, kwargs, seqs)
+        heapq.heappush(self._heap, entry)
+        if key is not None:
+            self._pending[key] = entry
+        return True
+
+    def next_due(self):
+        """
+        Returns the due time of the next task.
+
+        @returns - Float unix time or None if nothing is scheduled
+
+        """
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def pop_due(self, now):
+        """
+        Removes and returns all tasks that are due.
+
+        @param now - Float unix time
+        @returns - List of (func, args, kwargs, seqs) tuples in due order
+
+        """
+        tasks = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, key, func, args, kwargs, seqs = heapq.heappop(self._heap)
+            if key is not None:
+                del self._pending[key]
+            tasks.append((func, args, kwargs, seqs))
+        return tasks
+
+    def __len__(self):
+        """
+        Returns the number of pending tasks.
+
+        @returns - Integer
+
+        """
+        return len(self._heap)
+
+    def stats(self):
+        """
+        Returns the schedule depth and how many tasks were coalesced.
+
+        @returns - Dictionary
+
+        """
+        return {
+            'depth': len(self._heap),
+            'coalesced': self.coalesced
+        }
@@ -1,6 +1,9 @@
+import backfill
 import config
 import gerrit
+import journal
 import log
+import scheduler
 import signal
 import time
 import thread
@@ -10,50 +13,220 @@ import upstream
 
 logger = log.get_logger()
 
+# Seconds between checks of the configuration file by event filters
+CONFIG_CHECK_INTERVAL = 1
+
+
+def downstream_event_types(conf):
+    """
+    Returns the set of event types needed from the downstream stream.
+    comment-added events are only needed when sending upstream is enabled.
+
+    @param conf - Dictionary
+    @return Set of Strings
+
+    """
+    types = set()
+    if conf['daemon']['upstream']:
+        types.add('comment-added')
+    return types
+
+
+def upstream_event_types(conf):
+    """
+    Returns the set of event types needed from the upstream stream.
+    ref-updated events are only needed when syncing is enabled.
+
+    @param conf - Dictionary
+    @return Set of Strings
+
+    """
+    types = set()
+    if conf['daemon']['sync']:
+        types.add('ref-updated')
+    return types
+
+
+def downstream_event_filter(conf):
+    """
+    Returns a raw event filter for the downstream stream. Only comment-added
+    events on upstream projects that mention the trigger are kept.
+
+    @param conf - Dictionary
+    @return gerrit.RawEventFilter
+
+    """
+    event_filter = gerrit.RawEventFilter()
+    if conf['daemon']['upstream']:
+        event_filter.add_rule('comment-added',
+                              projects=conf.upstream_projects,
+                              text=conf['upstream']['trigger'])
+    return event_filter
+
+
+def upstream_event_filter(conf):
+    """
+    Returns a raw event filter for the upstream stream. Only ref-updated
+    events on configured projects are kept.
+
+    @param conf - Dictionary
+    @return gerrit.RawEventFilter
+
+    """
+    event_filter = gerrit.RawEventFilter()
+    if conf['daemon']['sync']:
+        event_filter.add_rule('ref-updated', projects=conf.project_names())
+    return event_filter
+
+
+class ReloadingEventFilter(object):
+    """
+    Raw event filter that follows changes to the configuration file. The
+    file is checked at most once every CONFIG_CHECK_INTERVAL seconds and
+    the filter is built again whenever config.get_config returns a new
+    configuration, so projects and the trigger can change without a
+    restart.
 
-def pull_downstream(conf, stream, pool, schedule, yaml_file):
     """
-    Pulls an event from the queue on downstream.
+    def __init__(self, yaml_file, build):
+        """
+        Inits the filter and builds it from the current configuration.
+
+        @param yaml_file - String location of the configuration
+        @param build - Function taking a config.Config and returning a
+            raw event filter
+
+        """
+        self._yaml_file = yaml_file
+        self._build = build
+        self._conf = config.get_config(yaml_file)
+        self._filter = build(self._conf)
+        self._checked = time.time()
+
+    def __call__(self, line):
+        """
+        Returns whether or not the raw event line should be kept.
+
+        @param line - String raw JSON event
+        @returns - Boolean
+
+        """
+        now = time.time()
+        if now - self._checked >= CONFIG_CHECK_INTERVAL:
+            self._checked = now
+            self._reload()
+        return self._filter(line)
+
+    def _reload(self):
+        """
+        Builds the filter again if the configuration changed. A
+        configuration that can't be read is logged and the current filter
+        is kept.
+
+        """
+        try:
+            conf = config.get_config(self._yaml_file)
+        except Exception:
+            logger.exception("Unable to reload configuration for the event"
+                             " filter")
+            return
+        if conf is not self._conf:
+            logger.info("Configuration changed, rebuilding event filter")
+            self._filter = self._build(conf)
+            self._conf = conf
+
+
+def start_stream(remote, event_types, event_filter, dispatcher, name,
+                 journal_=None, backfill_=None):
+    """
+    Starts an event stream subscribed to event_types that pushes into the
+    dispatcher. No stream is started when no event types are needed.
+
+    @param remote - gerrit.Remote
+    @param event_types - Set of event type names
+    @param event_filter - Callable raw event filter or None
+    @param dispatcher - thread.Dispatcher
+    @param name - String name of the stream
+    @param journal_ - journal.Journal to record events in or None
+    @param backfill_ - Callable returning events missed while disconnected
+    @return gerrit.SSHStream | None
+
+    """
+    if not event_types:
+        return None
+    stream = remote.SSHStream(event_types=event_types,
+                              event_filter=event_filter,
+                              dispatcher=dispatcher,
+                              name=name,
+                              journal=journal_,
+                              backfill=backfill_)
+    stream.start()
+    return stream
+
+
+def add_task(pool, journal_, seqs, func, *args, **kwargs):
+    """
+    Adds a task to the pool. When journaling, the task commits seqs once
+    it is finished.
+
+    @param pool - thread.WorkerPool
+    @param journal_ - journal.Journal or None
+    @param seqs - List of journal sequence numbers the task completes
+    @param func - Function to run
+    @param *args - Args to send to function
+    @param **kwargs - Kwargs to send to function
+
+    """
+    if journal_ is not None and seqs:
+        func = journal_.completes(func, seqs)
+    pool.add_task(func, *args, **kwargs)
+
+
+def handle_downstream(conf, event, pool, schedule, yaml_file, seq=None,
+                      journal_=None):
+    """
+    Handles an event from downstream.
     Filters and assigns tasks to handle this event.
-    Does nothing if there is no event.
 
     @param conf - Dictionary
-    @param stream - gerrit.SSHStream object
+    @param event - Decoded event dictionary
     @param pool - thread.WorkerPool
-    @param schedule - List of (time, tasks) tuples. Use to schedule
-        events later.
+    @param schedule - scheduler.Scheduler. Use to schedule events later.
     @param yaml_file - Location of configuration file
-    @return Boolean - True if event was process, False Otherwise
+    @param seq - Integer journal sequence number of the event or None
+    @param journal_ - journal.Journal or None
+    @return Boolean True if a task was created that will commit seq
 
     """
-    event = stream.get_event()
     # Look for comment added type events
-    if event and event.get('type') == 'comment-added':
+    if event.get('type') == 'comment-added':
         if conf['daemon']['upstream']:
             args = [yaml_file, event]
             kwargs = {}
-            pool.add_task(upstream.send_upstream, *args, **kwargs)
-    return event is not None
+            add_task(pool, journal_, [seq] if seq else [],
+                     upstream.send_upstream, *args, **kwargs)
+            return True
+    return False
 
 
-def pull_upstream(_config, stream, pool, schedule, yaml_file):
+def handle_upstream(_config, event, pool, schedule, yaml_file, seq=None,
+                    journal_=None):
     """
-    Pulls an event from the queue on upstream.
-    Filters and assigns tasks to handle this event.
-    Does nothing if there is no event.
+    Handles an event from upstream.
+    Filters and schedules tasks to handle this event.
 
     @param conf - Dictionary
-    @param stream - gerrit.SSHStream object
+    @param event - Decoded event dictionary
     @param pool - thread.WorkerPool
-    @param schedule - List of (time, tasks) tuples. Use to schedule
-        events later.
+    @param schedule - scheduler.Scheduler. Use to schedule events later.
     @param yaml_file - Location of configuration file
-    @return Boolean - True if event was process, False Otherwise
+    @param seq - Integer journal sequence number of the event or None
+    @param journal_ - journal.Journal or None
+    @return Boolean True if a task was scheduled that will commit seq
 
     """
     delay = int(_config['daemon']['delay'])
-    event = stream.get_event()
-    if event and event.get('type') == 'ref-updated':
+    if event.get('type') == 'ref-updated':
         if _config['daemon']['sync']:
             name = event['refUpdate']['project']
             t = time.time() + delay
@@ -62,11 +235,22 @@ def pull_upstream(_config, stream, pool, schedule, yaml_file):
                 'yaml_file': yaml_file,
                 'users': False,
                 'groups': False,
-                'project': name
+                'project': name,
+                'trust_state': True
             }
-            schedule.append((t, sync.sync, args, kwargs))
+            key = ('sync', name)
+            seqs = [seq] if seq else []
+            if not schedule.add(t, sync.sync, args, kwargs, key=key,
+                                seqs=seqs):
+                logger.debug("Project %s: sync already scheduled" % name)
+            return True
+    return False
+
 
-    return event is not None
+HANDLERS = {
+    'downstream': handle_downstream,
+    'upstream': handle_upstream
+}
 
 
 def service(yaml_file):
@@ -76,14 +260,19 @@ def service(yaml_file):
     if things need to be delayed.
 
     Runs in infinite loop until killed.
-    Each loop iteration consists of checking the schedule, checking
-    downstream, then checking upstream. Sleep if no action taken.
+    Each loop iteration moves due scheduled tasks to the pool, then blocks
+    on the dispatcher both streams push into until an event arrives or the
+    next scheduled task is due.
+
+    When journaling is enabled events are journaled as they are received
+    and committed once the task they caused finishes. Events that were not
+    committed before the last shutdown are replayed first.
 
     @param yaml_file - String location to configuration
 
     """
     # Get configuraion
-    _config = config.load_config(yaml_file)
+    _config = config.get_config(yaml_file)
 
     numthreads = int(_config['daemon']['numthreads'])
     sleep = int(_config['daemon']['sleep'])
@@ -92,40 +281,67 @@ def service(yaml_file):
     signal.signal(signal.SIGINT, thread.stop_threads)
     signal.signal(signal.SIGTERM, thread.stop_threads)
 
-    schedule = list()
+    schedule = scheduler.Scheduler()
     pool = thread.WorkerPool(numthreads)
+    dispatcher = thread.Dispatcher()
+
+    journal_ = None
+    if _config['journal']['enabled']:
+        journal_ = journal.get_journal(_config)
+        replayed = journal_.replay()
+        if replayed:
+            logger.info("Replaying %s uncommitted event(s)." % len(replayed))
+        for seq, source, line in replayed:
+            dispatcher.put(source, line, seq=seq)
 
     downstream_remote = gerrit.Remote(_config['gerrit'])
-    downstream = downstream_remote.SSHStream()
-    downstream.start()
+    start_stream(downstream_remote,
+                 downstream_event_types(_config),
+                 ReloadingEventFilter(yaml_file, downstream_event_filter),
+                 dispatcher,
+                 'downstream',
+                 journal_=journal_,
+                 backfill_=backfill.downstream_backfill(downstream_remote,
+                                                        yaml_file))
 
     upstream_remote = gerrit.Remote(_config['upstream'])
-    upstream = upstream_remote.SSHStream()
-    upstream.start()
+    start_stream(upstream_remote,
+                 upstream_event_types(_config),
+                 ReloadingEventFilter(yaml_file, upstream_event_filter),
+                 dispatcher,
+                 'upstream',
+                 journal_=journal_,
+                 backfill_=backfill.upstream_backfill(yaml_file))
 
     while True:
-        downstream_active = False
-        upstream_active = False
+        # Move due scheduled tasks to the event pool
+        now = time.time()
+        for func, args, kwargs, seqs in schedule.pop_due(now):
+            add_task(pool, journal_, seqs, func, *args, **kwargs)
 
-        # Check schedule and add events to event pool
-        if len(schedule) > 0 and time.time() > schedule[0][0]:
-            t, func, args, kwargs = schedule.pop(0)
-            pool.add_task(func, *args, **kwargs)
-            continue
+        # Block until an event arrives or the next scheduled task is due.
+        # Never block longer than sleep so signals are still handled.
+        timeout = sleep
+        next_due = schedule.next_due()
+        if next_due is not None:
+            timeout = max(0, min(timeout, next_due - now))
+        logger.debug("Schedule depth: %(depth)s, coalesced: %(coalesced)s"
+                     % schedule.stats())
 
-        # Check for new events
-        downstream_active = pull_downstream(_config, downstream,
-                                            pool, schedule, yaml_file)
-        upstream_active = pull_upstream(_config, upstream,
-                                        pool, schedule, yaml_file)
-
-        if downstream_active:
-            logger.debug("Downstream is active")
-        if upstream_active:
-            logger.debug("Upstream is active")
-        logger.debug("Schedule len: %s" % len(schedule))
-
-        # Sleep if no events recieved.
-        if not downstream_active and not upstream_active:
-            time.sleep(sleep)
+        item = dispatcher.wait(timeout)
+        if item is None:
             continue
+
+        # Streams pass events they already decoded. Replays are raw lines.
+        source, event, seq = item
+        if not isinstance(event, dict):
+            event = gerrit.decode_event(event)
+        handled = False
+        if event is not None:
+            logger.debug("%s is active" % source.capitalize())
+            handled = HANDLERS[source](_config, event, pool, schedule,
+                                       yaml_file, seq=seq, journal_=journal_)
+
+        # Nothing else will commit an event that caused no work
+        if not handled and journal_ is not None and seq:
+            journal_.commit(seq)
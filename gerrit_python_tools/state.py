@@ -0,0 +1,268 @@
+"""
+Small persistent store for state that should survive between runs, such
+as what was last pushed to a project's refs/meta/config, the source refs
+a project was last synced with and the revisions already sent upstream.
+
+"""
+import atexit
+import log
+import os
+import sqlite3
+import threading
+import time
+
+logger = log.get_logger()
+
+# Writes are committed once this many are pending...
+BATCH_SIZE = 100
+
+# ...or once the oldest pending write is this many seconds old.
+FLUSH_INTERVAL = 1.0
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS source_refs (
+        project TEXT NOT NULL,
+        ref TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        PRIMARY KEY (project, ref)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS synced_projects (
+        project TEXT PRIMARY KEY,
+        synced REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS meta_config (
+        project TEXT PRIMARY KEY,
+        commit_id TEXT NOT NULL,
+        blob TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS upstreamed (
+        revision TEXT PRIMARY KEY,
+        project TEXT NOT NULL,
+        change_id TEXT,
+        url TEXT,
+        sent REAL NOT NULL
+    )'''
+]
+
+
+class StateStore(object):
+    """
+    SQLite backed store. Safe to share between threads; every statement
+    runs on one connection under a lock. Writes are batched into a single
+    transaction that is committed once BATCH_SIZE writes are pending or
+    FLUSH_INTERVAL seconds have passed. Reads on the same connection see
+    pending writes.
+
+    """
+    def __init__(self, path):
+        """
+        Inits the store, creating the database if needed.
+
+        @param path - String location of the database file
+
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        for statement in SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+
+        self._pending = 0
+        self._oldest = None
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop)
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _write(self, statements):
+        """
+        Runs write statements as part of the current batch.
+
+        @param statements - List of (sql, params) tuples
+
+        """
+        with self._lock:
+            for sql, params in statements:
+                self._conn.execute(sql, params)
+            self._pending += 1
+            if self._oldest is None:
+                self._oldest = time.time()
+            if self._pending >= BATCH_SIZE:
+                self._commit()
+
+    def _commit(self):
+        """
+        Commits pending writes. Lock must be held.
+
+        """
+        if not self._pending:
+            return
+        try:
+            self._conn.commit()
+        except sqlite3.Error:
+            logger.exception("Unable to save state to %s" % self.path)
+        self._pending = 0
+        self._oldest = None
+
+    def _flush_loop(self):
+        """
+        Commits pending writes once they are FLUSH_INTERVAL seconds old.
+
+        """
+        while not self._stop.wait(FLUSH_INTERVAL / 2):
+            with self._lock:
+                if self._oldest is not None and \
+                        time.time() - self._oldest >= FLUSH_INTERVAL:
+                    self._commit()
+
+    def flush(self):
+        """
+        Commits pending writes now.
+
+        """
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        """
+        Commits pending writes and closes the database.
+
+        """
+        self._stop.set()
+        with self._lock:
+            self._commit()
+            self._conn.close()
+
+    def meta_config(self, project):
+        """
+        Returns the refs/meta/config commit and project.config blob last
+        seen on gerrit for a project.
+
+        @param project - String project name
+        @returns - Two tuple of (commit, blob) Strings or None
+
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT commit_id, blob FROM meta_config WHERE project = ?',
+                (project,)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def set_meta_config(self, project, commit, blob):
+        """
+        Records the refs/meta/config commit and project.config blob now on
+        gerrit for a project.
+
+        @param project - String project name
+        @param commit - String commit id of refs/meta/config
+        @param blob - String blob id of project.config
+
+        """
+        self._write([(
+            'INSERT OR REPLACE INTO meta_config (project, commit_id, blob)'
+            ' VALUES (?, ?, ?)',
+            (project, commit, blob)
+        )])
+
+    def source_refs(self, project):
+        """
+        Returns the source refs a project was last synced with.
+
+        @param project - String project name
+        @returns - Dictionary of ref names to hashes or None if the project
+            was never synced
+
+        """
+        with self._lock:
+            synced = self._conn.execute(
+                'SELECT 1 FROM synced_projects WHERE project = ?',
+                (project,)
+            ).fetchone()
+            if not synced:
+                return None
+            rows = self._conn.execute(
+                'SELECT ref, hash FROM source_refs WHERE project = ?',
+                (project,)
+            ).fetchall()
+        return dict(rows)
+
+    def set_source_refs(self, project, refs):
+        """
+        Records the source refs a project was just synced with.
+
+        @param project - String project name
+        @param refs - Dictionary of ref names to hashes
+
+        """
+        statements = [
+            ('DELETE FROM source_refs WHERE project = ?', (project,)),
+            ('INSERT OR REPLACE INTO synced_projects (project, synced)'
+             ' VALUES (?, ?)', (project, time.time()))
+        ]
+        for ref, hash_ in sorted(refs.items()):
+            statements.append((
+                'INSERT INTO source_refs (project, ref, hash)'
+                ' VALUES (?, ?, ?)',
+                (project, ref, hash_)
+            ))
+        self._write(statements)
+
+    def upstreamed(self, revision):
+        """
+        Returns whether or not a revision was already sent upstream.
+
+        @param revision - String revision
+        @returns - Boolean
+
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT 1 FROM upstreamed WHERE revision = ?', (revision,)
+            ).fetchone()
+        return row is not None
+
+    def set_upstreamed(self, revision, project, change_id, url):
+        """
+        Records that a revision was sent upstream.
+
+        @param revision - String revision
+        @param project - String project name
+        @param change_id - String change id
+        @param url - String url of the upstream change or None
+
+        """
+        self._write([(
+            'INSERT OR REPLACE INTO upstreamed'
+            ' (revision, project, change_id, url, sent)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            (revision, project, change_id, url, time.time())
+        )])
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_state_store(conf):
+    """
+    Returns the shared StateStore kept in the cache directory of conf.
+
+    @param conf - Configuration dictionary
+    @returns - state.StateStore
+
+    """
+    path = os.path.join(
+        os.path.abspath(os.path.expanduser(conf['cache']['dir'])), 'state.db')
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = StateStore(path)
+            atexit.register(store.close)
+            _stores[path] = store
+        return store
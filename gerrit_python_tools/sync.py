@@ -2,6 +2,9 @@ import config
 import gerrit
 import log
 import logging
+import Queue
+import reconcile
+import threading
 import time
 import traceback
 
@@ -9,53 +12,165 @@ import traceback
 logger = log.get_logger()
 
 
-def sync_groups(_config):
+def report(msg, error=False):
+    """
+    Logs and prints a message.
+
+    @param msg - String message
+    @param error - Boolean log as an error instead of info
+
+    """
+    log.report(msg, logging.ERROR if error else logging.INFO)
+
+
+def sync_groups(_config, dry_run=False):
     """
     Ensures groups listed described by _config are present. Will create them
     if they DO NOT exist but will leave them alone if they DO exist.
 
+    Existence is checked against the group directory, which is fetched
+    with a single command, and only missing groups are created.
+
     @param _config - Dictionary
+    @param dry_run - Boolean print the plan without creating anything
 
     """
     remote = gerrit.Remote(_config['gerrit'])
+    groups = []
     for group_data in _config.get('groups', []):
         try:
-            group = gerrit.Group(group_data)
-            group.present(remote)
-            print ""
+            groups.append(gerrit.Group(group_data))
         except:
             logger.exception("Unable to sync group")
             traceback.print_exc()
 
+    try:
+        directory = gerrit.get_group_directory(
+            remote, ttl=_config['daemon']['group_ttl'])
+        plan = reconcile.plan_groups(remote, groups, directory)
+        if dry_run:
+            report("\n".join(plan.lines()))
+            print ""
+            return
+
+        for name in plan.present:
+            report("Group %s: Already exists." % name)
+        for name, retcode, out in reconcile.apply_groups(remote, plan):
+            if not retcode:
+                report("Group %s: Created" % name)
+            else:
+                report("Group %s: Unable to create - %s" % (name, out),
+                       error=True)
+        if plan.missing:
+            gerrit.invalidate_group_directory(remote)
+        print ""
+    except:
+        logger.exception("Unable to sync groups")
+        traceback.print_exc()
 
-def sync_users(_config):
+
+def sync_users(_config, dry_run=False):
     """
     Ensures users desribed by _config are present. Will create them if they
     DO NOT exist but will leave them alone if they DO exist.
 
+    Existing accounts are listed with a single query and only missing
+    users are created.
+
     @param _config - Dictionary
+    @param dry_run - Boolean print the plan without creating anything
 
     """
     remote = gerrit.Remote(_config['gerrit'])
+    users = []
     for user_data in _config.get('users', []):
         try:
-            user = gerrit.User(user_data)
-            user.present(remote)
-            print ""
+            users.append(gerrit.User(user_data))
         except:
             logger.exception("Unable to sync user")
             traceback.print_exc()
 
+    try:
+        plan = reconcile.plan_users(remote, users)
+        if dry_run:
+            report("\n".join(plan.lines()))
+            print ""
+            return
+
+        for name in plan.present:
+            report("User %s: Already exists." % name)
+        for name, retcode, out in reconcile.apply_users(remote, plan):
+            if retcode is None:
+                report("User %s: Already exists." % name)
+            elif not retcode:
+                report("User %s: Created." % name)
+            else:
+                report("User %s: Unable to create - %s" % (name, out),
+                       error=True)
+        print ""
+    except:
+        logger.exception("Unable to sync users")
+        traceback.print_exc()
+
+
+def sync_project(project, remote, _config, groups, trust_state=False):
+    """
+    Ensures a single project, timing it and catching any error.
+
+    @param project - gerrit.Project
+    @param remote - gerrit.Remote
+    @param _config - Dictionary
+    @param groups - gerrit.GroupDirectory
+    @param trust_state - Boolean skip projects whose source has not moved
+        since the last recorded sync
+    @returns - Three tuple of project name, duration in seconds and the
+        error message or None on success.
+
+    """
+    start = time.time()
+    error = None
+    try:
+        project.ensure(remote, _config, groups=groups,
+                       trust_state=trust_state)
+    except Exception as e:
+        logger.exception("Project %s: Unable to sync project" % project.name)
+        traceback.print_exc()
+        error = str(e) or e.__class__.__name__
+    return project.name, time.time() - start, error
+
+
+def print_summary(results):
+    """
+    Logs and prints the duration and outcome of each synced project.
+
+    @param results - List of (name, duration, error) tuples
+
+    """
+    failures = [r for r in results if r[2] is not None]
+    lines = ["Project summary: %s synced, %s failed."
+             % (len(results) - len(failures), len(failures))]
+    for name, duration, error in sorted(results):
+        status = 'ok' if error is None else 'FAILED: %s' % error
+        lines.append("  %s: %.1fs %s" % (name, duration, status))
+    report("\n".join(lines), error=bool(failures))
+
 
-def sync_projects(_config, specific=None):
+def sync_projects(_config, specific=None, jobs=1, trust_state=False):
     """
     Syncs projects described in _config. Projects that are to be synced
     have a source repo. Syncing is the process of pushing those changes
     to downstream. Optionally, a specific project can be named and only
     that project will be synced.
 
+    Up to jobs projects are synced at once. Git operations against gerrit
+    are still limited by the remote's max_sessions.
+
     @param _config - Dictionary
     @param specific - String name of a specific project.
+    @param jobs - Integer number of projects to sync concurrently.
+    @param trust_state - Boolean skip projects whose source has not moved
+        since the last recorded sync instead of comparing with gerrit.
+    @returns - List of (name, duration, error) tuples
 
     """
     remote = gerrit.Remote(_config['gerrit'])
@@ -71,16 +186,45 @@ def sync_projects(_config, specific=None):
             logger.error(msg)
             print msg
 
+    # Fetch the group list once for every project's groups file
+    groups = None
+    if projects:
+        groups = gerrit.get_group_directory(
+            remote, ttl=_config['daemon']['group_ttl'])
+
+    pending = Queue.Queue()
     for p in projects:
-        try:
-            p.ensure(remote, _config)
-            print ""
-        except:
-            logger.exception("Unable to sync project")
-            traceback.print_exc()
+        pending.put(p)
+
+    results = []
+
+    def work():
+        while True:
+            try:
+                p = pending.get_nowait()
+            except Queue.Empty:
+                return
+            results.append(sync_project(p, remote, _config, groups,
+                                        trust_state=trust_state))
+
+    threads = []
+    for _ in range(max(1, min(int(jobs), len(projects)))):
+        t = threading.Thread(target=work)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    # Join with a timeout so the main thread still handles signals.
+    for t in threads:
+        while t.is_alive():
+            t.join(1)
+
+    print_summary(results)
+    return results
 
 
-def sync(yaml_file=None, groups=True, users=True, projects=True, project=None):
+def sync(yaml_file=None, groups=True, users=True, projects=True, project=None,
+         jobs=1, dry_run=False, trust_state=False):
     """
     Main sync entry point. Orchestrates the syncing of users, groups, and
     projects as described by a yaml file.
@@ -90,22 +234,31 @@ def sync(yaml_file=None, groups=True, users=True, projects=True, project=None):
     @param users - Boolean Users will be synced if true.
     @param projects - Boolean Projects will be synced if true.
     @param project - String specific project to sync.
+    @param jobs - Integer number of projects to sync concurrently.
+    @param dry_run - Boolean print what groups and users would be created
+        without changing anything. Projects are skipped.
+    @param trust_state - Boolean skip projects whose source has not moved
+        since the last recorded sync. Used by the daemon; one off runs
+        always compare with gerrit.
 
     """
     try:
-        _config = config.load_config(yaml_file)
+        _config = config.get_config(yaml_file)
 
         start = time.time()
         logger.info("gerrit-sync starting...")
 
         if groups:
-            sync_groups(_config)
+            sync_groups(_config, dry_run=dry_run)
 
         if users:
-            sync_users(_config)
+            sync_users(_config, dry_run=dry_run)
 
-        if projects:
-            sync_projects(_config, specific=project)
+        if projects and dry_run:
+            report("Projects: Skipped for dry run.")
+        elif projects:
+            sync_projects(_config, specific=project, jobs=jobs,
+                          trust_state=trust_state)
 
         duration = time.time() - start
         msg = "gerrit-sync run finished in %s seconds." % duration
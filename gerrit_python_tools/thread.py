@@ -2,7 +2,6 @@ import log
 import Queue
 import sys
 import threading
-import time
 
 _stopped = threading.Event()
 logger = log.get_logger()
@@ -51,13 +50,22 @@ class Worker(StoppableThread):
         logger.debug("Worker thread started.")
         self.start()
 
+    def stop(self):
+        """
+        Sets the stop event and puts a None on the queue for one worker of
+        the pool to end on. Any worker may pull it, so stopping every worker
+        of the pool ends them all.
+
+        """
+        super(Worker, self).stop()
+        self.queue.put(None)
+
     def run(self):
         """
         Run loop of the worker thread.
-        Checks to see if the thread should stop.
-        Tries to pull a tuple from the queue.
+        Blocks until a tuple is pulled from the queue.
         The tuple should be in the form (function, args, kwargs)
-        Sleeps if the queue is empty.
+        A None in the queue ends the worker that pulls it.
 
         """
         while True:
@@ -66,13 +74,15 @@ class Worker(StoppableThread):
                 logger.debug("Worker thread stopping.")
                 break
 
-            # Try to pull from the queue
+            # Block until a task or a None arrives
+            task = self.queue.get()
+            if task is None:
+                logger.debug("Worker thread stopping.")
+                break
+
             try:
-                func, args, kwargs = self.queue.get_nowait()
+                func, args, kwargs = task
                 func(*args, **kwargs)
-            except Queue.Empty:
-                time.sleep(5)
-                continue
             except Exception as e:
                 logger.exception(e)
 
@@ -108,6 +118,53 @@ class WorkerPool(object):
         self.queue.put((func, args, kwargs))
 
 
+class Dispatcher(object):
+    """
+    Single queue that several event sources push into. The consumer blocks
+    on the queue instead of polling each source.
+
+    """
+    def __init__(self):
+        """
+        Inits the dispatcher queue.
+
+        """
+        self._queue = Queue.Queue()
+
+    def put(self, source, item, seq=None):
+        """
+        Adds an item from a source.
+
+        @param source - String name of the source
+        @param item - Item to dispatch
+        @param seq - Integer journal sequence number of the item or None
+
+        """
+        self._queue.put((source, item, seq))
+
+    def wait(self, timeout):
+        """
+        Blocks until an item is available or timeout seconds pass.
+
+        @param timeout - Number of seconds to wait
+        @returns - (source, item, seq) tuple or None if the wait timed out
+
+        """
+        try:
+            return self._queue.get(True, timeout)
+        except Queue.Empty:
+            return None
+
+    def __len__(self):
+        """
+        Returns the approximate number of items waiting.
+
+        @returns - Integer
+
+        """
+        return self._queue.qsize()
+
+
 def stop_threads(signal, frame):
     """
     Handles sig int. Iterates over stoppable threads and instructs
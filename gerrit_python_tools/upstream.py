@@ -18,7 +18,7 @@ def send_upstream(yaml_file, event):
 
     """
     try:
-        _config = config.load_config(yaml_file)
+        _config = config.get_config(yaml_file)
 
         start = time.time()
         logger.info("send upstream starting...")
@@ -1,49 +1,112 @@
 import json
 import cStringIO
 
+# Returned by MultiJSON._decode_next once there are no more objects
+_END = object()
+
 
 class MultiJSON(object):
     """
-    Class for parsing multiple JSON objects out of a single string.
+    Class for parsing multiple JSON objects, one per line, out of a string
+    or a file like object such as an ssh channel. Objects are decoded
+    lazily as they are asked for, so a reader that only needs the first
+    object never reads or decodes the rest.
+
+    Objects reached by index are kept so they can be asked for again.
+    Iterating yields objects without keeping them, so a full iteration
+    only holds one decoded object at a time. Objects consumed by iteration
+    can't be indexed afterwards.
 
     """
     def __init__(self, data):
         """
-        Inits the MultiJSON object. Places the string into a cStringIO
-        and reads one line at a time. json.loads is then executed on each
-        line.
+        Inits the MultiJSON object. A string is wrapped in a cStringIO,
+        which shares the string instead of copying it. Nothing is read
+        until an object is asked for.
+
+        @param data - String containing multiple json objects or an
+            iterable of lines
+
+        """
+        if isinstance(data, basestring):
+            data = cStringIO.StringIO(data)
+        self._lines = iter(data)
+        self.objects = []
+        self.exhausted = False
+        self._iterated = False
+        self._consumed = 0
+
+    def _decode_next(self):
+        """
+        Decodes the next object.
 
-        @param data - String containing multiple json objects
+        @return - Parsed json object or _END if there are no more objects
 
         """
-        buffer_ = cStringIO.StringIO(data)
-        self.objects = [json.loads(line) for line in buffer_.readlines()]
+        for line in self._lines:
+            if not line.strip():
+                continue
+            return json.loads(line)
+        self.exhausted = True
+        return _END
+
+    def _cache_next(self):
+        """
+        Decodes the next object and caches it.
+
+        @return - Boolean False if there are no more objects
+        @raises - ValueError if iteration already consumed objects
+
+        """
+        if self._iterated and not self.exhausted:
+            raise ValueError("Objects were consumed by iteration")
+        obj = self._decode_next()
+        if obj is _END:
+            return False
+        self.objects.append(obj)
+        return True
 
     def __getitem__(self, index):
         """
-        Returns the json object at index index.
+        Returns the json object at index index. Objects up to index are
+        decoded and kept if they haven't been yet.
 
         @param index - Integer index
         @return - JSON object
 
         """
+        if index < 0:
+            len(self)
+        while len(self.objects) <= index and self._cache_next():
+            pass
         return self.objects[index]
 
     def __iter__(self):
         """
-        Iterate over the objects
+        Iterate over the objects. Kept objects are yielded first and the
+        rest are decoded as they are reached without being kept.
 
         @yields - Parsed json object.
 
         """
-        for obj in self.objects:
+        for obj in list(self.objects):
+            yield obj
+        self._iterated = True
+        while True:
+            obj = self._decode_next()
+            if obj is _END:
+                return
+            self._consumed += 1
             yield obj
 
     def __len__(self):
         """
-        Return the number of json objects.
+        Return the number of json objects, including those consumed by
+        iteration. Decodes and keeps every object not read yet.
 
         @return - Integer
 
         """
-        return len(self.objects)
+        while self._cache_next():
+            pass
+        return len(self.objects) + self._consumed
@@ -0,0 +1,190 @@
+"""
+Pool of persistent work trees used to send changes upstream. Each project
+keeps a workspace with its remotes configured and its objects kept between
+tasks, so a task only has to fetch the patchset it sends. A workspace may
+borrow objects from the project's source mirror so that even its first
+fetch only transfers what the mirror is missing.
+
+"""
+import fcntl
+import git
+import hashlib
+import log
+import mirror
+import os
+import shutil
+from contextlib import contextmanager
+
+logger = log.get_logger()
+
+# Branch a workspace checks patchsets out onto
+WORK_BRANCH = 'gerrit-python-tools/send'
+
+
+class WorkspacePool(object):
+    """
+    Directory of workspaces keyed by project. A workspace is leased to one
+    task at a time using a lock file, which also works across processes.
+    The lock file's modification time records when the workspace was last
+    used and drives LRU eviction.
+
+    """
+    def __init__(self, root, max_size):
+        """
+        Inits the pool.
+
+        @param root - String directory to keep workspaces in
+        @param max_size - Integer max total size of workspaces in bytes
+
+        """
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.max_size = int(max_size)
+
+    def path_for(self, project):
+        """
+        Returns the location of the workspace for a project.
+
+        @param project - String project name
+        @returns - String path
+
+        """
+        name = hashlib.sha1(project).hexdigest()
+        return os.path.join(self.root, '%s.git' % name)
+
+    @contextmanager
+    def lease(self, project, remotes, mirror_path=None):
+        """
+        Context manager that locks the workspace of project, creates it if
+        needed, points its remotes at remotes and yields its path. Stale
+        workspaces are evicted afterwards.
+
+        If mirror_path is given and the mirror exists, the workspace
+        borrows its objects. The mirror's lock is held shared for the
+        lease so it can't be evicted or updated while in use.
+
+        @param project - String project name
+        @param remotes - Dictionary of remote names to urls
+        @param mirror_path - String path of a bare mirror of the project
+        @yields - String path of the workspace
+
+        """
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+        path = self.path_for(project)
+        with open('%s.lock' % path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                os.utime(lock.name, None)
+                with self._borrow(mirror_path) as alternate:
+                    self._prepare(path, remotes, alternate)
+                    yield path
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.evict(keep=path)
+
+    @contextmanager
+    def _borrow(self, mirror_path):
+        """
+        Context manager that holds a shared lock on a mirror and yields its
+        objects directory, or None if there is no usable mirror.
+
+        @param mirror_path - String path of a bare mirror or None
+        @yields - String path | None
+
+        """
+        if not mirror_path or not os.path.isdir(mirror_path):
+            yield None
+            return
+
+        with open('%s.lock' % mirror_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            try:
+                objects = os.path.join(mirror_path, 'objects')
+                # The mirror may have been evicted while waiting on the lock
+                yield objects if os.path.isdir(objects) else None
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _prepare(self, path, remotes, alternate=None):
+        """
+        Creates the workspace if it does not exist and sets the url of each
+        remote. Urls are set on every lease since the upstream user may
+        differ between changes. A workspace borrowing objects from a
+        different mirror than alternate is created again, since it can't
+        be trusted to have every object it needs. Lock must be held.
+
+        @param path - String path of the workspace
+        @param remotes - Dictionary of remote names to urls
+        @param alternate - String path of an objects directory to borrow
+            objects from or None
+
+        """
+        if os.path.isdir(os.path.join(path, '.git')):
+            current = git.get_alternates(cwd=path)
+            if current and current != [alternate]:
+                logger.info("Workspace %s: alternates changed, recreating"
+                            % path)
+                shutil.rmtree(path)
+
+        if not os.path.isdir(os.path.join(path, '.git')):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            logger.info("Workspace %s: creating" % path)
+            tmp_path = '%s.tmp' % path
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+            os.makedirs(tmp_path)
+            git.init(cwd=tmp_path)
+            for name, url in sorted(remotes.items()):
+                git.add_remote(name, url, cwd=tmp_path)
+            os.rename(tmp_path, path)
+        else:
+            for name, url in sorted(remotes.items()):
+                git.set_config('remote.%s.url' % name, url, cwd=path)
+
+        if alternate:
+            git.set_alternates([alternate], cwd=path)
+
+    def checkout(self, path, remote, ref):
+        """
+        Resets a leased workspace to a single ref fetched from remote.
+        Local changes and untracked files left by an earlier task are
+        thrown away.
+
+        @param path - String path of the workspace
+        @param remote - String name of the remote to fetch from
+        @param ref - String ref to fetch, such as refs/changes/45/12345/2
+
+        """
+        git.fetch(remote, refspecs=[ref], cwd=path)
+        git.checkout_branch(WORK_BRANCH, new=True, start='FETCH_HEAD',
+                            force=True, cwd=path)
+        git.clean(cwd=path)
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used workspaces until the total size of the
+        pool is within max_size. Workspaces that are currently leased are
+        skipped.
+
+        @param keep - String path of a workspace that should not be evicted
+
+        """
+        mirror.evict_lru(self.root, self.max_size, keep=keep)
+
+
+def get_workspace_pool(conf):
+    """
+    Returns a WorkspacePool described by the cache section of conf.
+
+    @param conf - Configuration dictionary
+    @returns - workspace.WorkspacePool
+
+    """
+    cache = conf['cache']
+    return WorkspacePool(
+        os.path.join(cache['dir'], 'workspaces'),
+        int(cache['workspace_size']) * 1024 * 1024
+    )